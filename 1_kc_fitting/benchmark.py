@@ -0,0 +1,150 @@
+'''
+Times the stages of the KC fitting pipeline on the QMC and DFT data with fixed seeds, without a cluster
+`eval_energy`: energies of the data points, also for data sets resampled to larger sizes
+`fit`: one weighted fit from the Ouyang parameters as in `kc.fit`, reporting the optimizer iterations `nfev`
+`gen_kc`: KC curves of the fitted model as in `gen_kc.gen_kc`
+`stats`: r2 and rms of the fitted model in the `min` and `far` ranges as in `gen_stats.collect_stats`
+`find_min`: minimum of every stacking of the curves as in `bootstrap_kc_find_min.py`
+Every stage is timed for each backend and the results are written to `processed/benchmark.json`.
+The LAMMPS backends take tens of ms per geometry, so their `fit` stage takes hours on the DFT data; select the stages with `--stages`.
+`peak_rss` is the high-water mark of the process in MB after the stage.
+`time` is measured with the pair geometry cache of `kc_numpy` cleared before every call, as in a fresh script,
+and `time_warm` with the geometry of the previous call cached, as in the later iterations of a fit.
+'''
+import argparse
+import datetime
+import json
+import numpy as np
+import os
+import resource
+import subprocess
+import time
+
+import bootstrap_kc_find_min
+import gen_stats
+import kc
+import kc_numpy
+import read
+
+def get_peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def clear_caches():
+    kc_numpy._get_pair_geometry.cache_clear()
+
+def timeit(func, nrepeat=1):
+    '''
+    Returns the result of the last call, and the best cold and warm times of `nrepeat` calls each
+    The caches are cleared before every cold call, the warm calls follow a cold one
+    '''
+    cold = []
+    warm = []
+    for _ in range(nrepeat):
+        clear_caches()
+        start = time.perf_counter()
+        result = func()
+        cold.append(time.perf_counter() - start)
+    for _ in range(nrepeat):
+        start = time.perf_counter()
+        result = func()
+        warm.append(time.perf_counter() - start)
+    return result, min(cold), min(warm)
+
+def resample(df, npoints, seed):
+    return df.sample(npoints, replace=True, random_state=seed).reset_index(0, drop=True)
+
+def bench_method(method, backend, stages, sizes, nrepeat, seed, freq):
+    '''
+    Runs `stages` for one method and backend, returns a list of records
+    '''
+    df = read.read_data(method)
+    p0, energy_inf = kc.get_starting_guess(df, method, 'inf', starting_guess='ouyang')
+    record = lambda stage, **kwargs: dict(method=method, backend=backend, stage=stage, **kwargs, peak_rss=get_peak_rss())
+    l = []
+
+    if 'eval_energy' in stages:
+        for npoints in [len(df)] + sizes:
+            dd = df if npoints == len(df) else resample(df, npoints, seed)
+            _, t, t_warm = timeit(lambda: kc.eval_energy(dd, *p0, keep_tmp_files=False, backend=backend), nrepeat)
+            l.append(record('eval_energy', npoints=npoints, time=t, time_warm=t_warm, evals_per_sec=npoints/t, evals_per_sec_warm=npoints/t_warm))
+
+    # the later stages use the fitted model, or the starting guess if the fit is skipped
+    popt = p0
+    if 'fit' in stages:
+        rng = np.random.default_rng(seed)
+        ydata = rng.normal(loc=df['energy'], scale=df['energy_err'])
+        weights, sigma = kc.get_weights(ydata, '0.004')
+        # the fit is run once from a cleared cache, its later iterations reuse the geometry of the first
+        clear_caches()
+        start = time.perf_counter()
+        popt, pcov, infodict = kc.fit_params(df, ydata, p0, energy_inf, sigma=sigma,
+            tmp_dir='lmp_tmp_benchmark', backend=backend, verbose=False, full_output=True)
+        t = time.perf_counter() - start
+        nfev = int(infodict['nfev'])
+        l.append(record('fit', npoints=len(df), time=t, nfev=nfev, evals_per_sec=nfev*len(df)/t))
+
+    if 'gen_kc' in stages or 'find_min' in stages:
+        ks, t, t_warm = timeit(lambda: kc.eval_curves([popt], ['benchmark'], freq=freq, backend=backend), nrepeat)
+        k = ks[0]
+        if 'gen_kc' in stages:
+            l.append(record('gen_kc', npoints=len(k), time=t, time_warm=t_warm, evals_per_sec=len(k)/t, evals_per_sec_warm=len(k)/t_warm))
+
+    if 'stats' in stages:
+        _, t, t_warm = timeit(lambda: [gen_stats.get_r2_rms(df, popt, lim, backend=backend) for lim in ['min', 'far']], nrepeat)
+        l.append(record('stats', npoints=2*len(df), time=t, time_warm=t_warm))
+
+    if 'find_min' in stages:
+        _, t, t_warm = timeit(lambda: [bootstrap_kc_find_min.find_min(g) for _, g in k.groupby('stacking')], nrepeat)
+        l.append(record('find_min', npoints=len(k), time=t, time_warm=t_warm))
+    return l
+
+def get_stages():
+    return ['eval_energy', 'fit', 'gen_kc', 'stats', 'find_min']
+
+def run_benchmark(methods=['QMC', 'DFT-D2'], backends=['numpy'], stages=None, sizes=[1000], nrepeat=3, seed=0, freq=0.01,
+        out_filename='processed/benchmark.json'):
+    '''
+    `sizes`: numbers of data points, resampled from the data with `seed`, for the scaling of `eval_energy`
+    `nrepeat`: cold and warm calls per stage, the best times are reported. The fit is run once from a cleared cache
+    '''
+    stages = get_stages() if stages is None else stages
+    l = []
+    for method in methods:
+        for backend in backends:
+            print(f'{method} {backend}')
+            records = bench_method(method, backend, stages, sizes, nrepeat, seed, freq)
+            for r in records:
+                print(r)
+            l += records
+
+    result = {
+        'commit': get_commit(),
+        'date': datetime.datetime.now().isoformat(),
+        'seed': seed,
+        'nrepeat': nrepeat,
+        'stages': stages,
+        'results': l,
+        }
+    os.makedirs(os.path.dirname(out_filename), exist_ok=True)
+    with open(out_filename, 'w') as f:
+        f.write(json.dumps(result, indent=4))
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--methods', nargs='+', default=['QMC', 'DFT-D2'])
+    parser.add_argument('--backends', nargs='+', default=['numpy'], choices=['numpy', 'lammps', 'lammps_session'])
+    parser.add_argument('--stages', nargs='+', default=get_stages(), choices=get_stages())
+    parser.add_argument('--sizes', nargs='*', default=[1000], type=int)
+    parser.add_argument('--nrepeat', default=3, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('-o', '--output', default='processed/benchmark.json')
+    args = parser.parse_args()
+    run_benchmark(methods=args.methods, backends=args.backends, stages=args.stages, sizes=args.sizes, nrepeat=args.nrepeat, seed=args.seed,
+        out_filename=args.output)
@@ -5,8 +5,12 @@ by fitting multiple models to data points, each of which is a gaussian variable
 import h5py
 import matplotlib.pyplot as plt
 import numpy as np
+import os
 import pandas as pd
 
+import bootstrap_kc_fit
+import kc
+
 def read_hdf(fn):
     with h5py.File(fn, 'r') as f:
         popt = f['popt'][()]
@@ -14,6 +18,18 @@ def read_hdf(fn):
     return popt, pcov
 
 
+def read_bootstrap_kc(method, kT, nmodels=20):
+    '''
+    Returns the KC curves of the bootstrap models.
+    The curves are evaluated from the stacked parameters of `bootstrap_kc_fit.py` if available,
+    otherwise they are read from `kc.csv` of the models fitted one by one
+    '''
+    if os.path.isfile(bootstrap_kc_fit.get_hdf_filename(method, kT)):
+        popt, pcov = bootstrap_kc_fit.read_bootstrap(method, kT)
+        labels = [f'fit-bootstrap/{method}-{model_id:02}-kT{kT}' for model_id in range(len(popt))]
+        return kc.eval_curves(popt, labels)
+    return [pd.read_csv(f'fit_bootstrap/{method}_{model_id:02}_kT{kT}/kc.csv') for model_id in range(nmodels)]
+
 def quad(x, c2, c1, c0):
     return c2*x**2 + c1*x + c0
 
@@ -38,9 +54,7 @@ def print_aggregated_dmin():
     q = pd.read_csv('data/qmc.csv')
     fig, axs = plt.subplots(nrows=1, ncols=4, sharey=True, sharex=True)
     dmin = []
-    for model_id in range(20):
-        csvname = f'fit_bootstrap/QMC_{model_id:02}_kT0.004/kc.csv'
-        d = pd.read_csv(csvname)
+    for model_id, d in enumerate(read_bootstrap_kc('QMC', '0.004')):
         d = d.drop(['disregistry', 'label'], axis=1)
         for i, stacking in enumerate(d['stacking'].unique()):
             ax = axs[i]
@@ -59,9 +73,7 @@ def print_aggregated_dmin():
 
 def print_aggregated_be():
     be_list = []
-    for model_id in range(20):
-        csvname = f'fit_bootstrap/QMC_{model_id:02}_kTinf/kc.csv'
-        d = pd.read_csv(csvname)
+    for model_id, d in enumerate(read_bootstrap_kc('QMC', 'inf')):
         d = d.drop(['disregistry', 'label'], axis=1)
         energy_inf = d['energy_inf'].values[0]
         for i, stacking in enumerate(d['stacking'].unique()):
@@ -0,0 +1,101 @@
+'''
+Fits multiple KC models concurrently, each to data points resampled as gaussian variables with standard deviation equal to the QMC error bar.
+Every model draws its noise from its own stream spawned from one `SeedSequence`, so the models do not depend on the number of workers.
+The models are stacked along the first axis of `fit_bootstrap/{method}_kT{kT}/bootstrap.hdf5`,
+and a run that was interrupted resumes from the models that are missing in that file.
+'''
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import datetime
+import h5py
+import numpy as np
+import os
+
+import kc
+import read
+
+def get_hdf_filename(method, kT):
+    return f'fit_bootstrap/{method}_kT{kc.get_kT_str(kT)}/bootstrap.hdf5'
+
+def fit_model(method, kT, seed_seq, starting_guess='old_fit', backend='lammps'):
+    '''
+    Fits one model to the data resampled with the random stream of `seed_seq`
+    '''
+    df = read.read_data(method)
+    rng = np.random.default_rng(seed_seq)
+    ydata = rng.normal(loc=df['energy'], scale=df['energy_err'])
+    weights, sigma = kc.get_weights(ydata, kT)
+    p0, energy_inf = kc.get_starting_guess(df, method, kT, starting_guess=starting_guess)
+    # the LAMMPS backend writes its input files to a scratch directory owned by the worker
+    popt, pcov = kc.fit_params(df, ydata, p0, energy_inf, sigma=sigma, tmp_dir=f'lmp_tmp_{os.getpid()}', backend=backend, verbose=False)
+    return popt, pcov, ydata, weights
+
+def init_hdf(hdf_filename, method, kT, nmodels, ndata, seed):
+    '''
+    Creates the stacked output file, or checks that an existing one belongs to the same run
+    '''
+    if os.path.isfile(hdf_filename):
+        with h5py.File(hdf_filename, 'r') as f:
+            run = (f.attrs['method'], f.attrs['kT'], f.attrs['seed'], f['done'].shape[0])
+        if run != (method, kc.get_kT_str(kT), seed, nmodels):
+            raise ValueError(f'{hdf_filename} was created by a different run: (method, kT, seed, nmodels) = {run}')
+        return
+
+    os.makedirs(os.path.dirname(hdf_filename), exist_ok=True)
+    nparams = 9
+    with h5py.File(hdf_filename, 'w') as f:
+        f.attrs['method'] = method
+        f.attrs['kT'] = kc.get_kT_str(kT)
+        f.attrs['seed'] = seed
+        f['popt'] = np.full((nmodels, nparams), np.nan)
+        f['pcov'] = np.full((nmodels, nparams, nparams), np.nan)
+        f['ydata'] = np.full((nmodels, ndata), np.nan)
+        f['weights'] = np.full((nmodels, ndata), np.nan)
+        f['done'] = np.zeros(nmodels, dtype=bool)
+
+def run_bootstrap(method='QMC', kT='inf', nmodels=20, seed=0, nworkers=None, starting_guess='old_fit', backend='lammps'):
+    '''
+    Fits `nmodels` resampled models on a process pool with `nworkers` workers and stores them in `get_hdf_filename`
+    '''
+    print(datetime.datetime.now())
+    hdf_filename = get_hdf_filename(method, kT)
+    ndata = len(read.read_data(method))
+    init_hdf(hdf_filename, method, kT, nmodels, ndata, seed)
+    seed_seqs = np.random.SeedSequence(seed).spawn(nmodels)
+
+    with h5py.File(hdf_filename, 'a') as f:
+        todo = np.flatnonzero(~f['done'][()])
+        print(f'{nmodels - len(todo)} of {nmodels} models already done')
+        with ProcessPoolExecutor(max_workers=nworkers) as executor:
+            futures = {executor.submit(fit_model, method, kT, seed_seqs[i], starting_guess, backend): i for i in todo}
+            for future in as_completed(futures):
+                model_id = futures[future]
+                popt, pcov, ydata, weights = future.result()
+                f['popt'][model_id] = popt
+                f['pcov'][model_id] = pcov
+                f['ydata'][model_id] = ydata
+                f['weights'][model_id] = weights
+                f['done'][model_id] = True
+                f.flush()
+                print(f'model {model_id:02}: ' + kc.format_params(popt, prec=' 18.15f'))
+    print(datetime.datetime.now())
+
+def read_bootstrap(method, kT):
+    '''
+    Returns the stacked `popt` and `pcov` of the finished models
+    '''
+    with h5py.File(get_hdf_filename(method, kT), 'r') as f:
+        done = f['done'][()]
+        popt = f['popt'][()][done]
+        pcov = f['pcov'][()][done]
+    return popt, pcov
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-kT', default='inf')
+    parser.add_argument('--method', default='QMC')
+    parser.add_argument('--nmodels', default=20, type=int)
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--nworkers', default=None, type=int)
+    args = parser.parse_args()
+    run_bootstrap(method=args.method, kT=args.kT, nmodels=args.nmodels, seed=args.seed, nworkers=args.nworkers)
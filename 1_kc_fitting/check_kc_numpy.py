@@ -0,0 +1,68 @@
+'''
+Checks that `kc_numpy.py` gives the energies of LAMMPS `kolmogorov/crespi/full`
+
+The energies of the four stackings are compared on a grid of interlayer distances for several cell heights `c`,
+whose images along z enter the cutoff at large distance, with the LAMMPS python module (`kc_lammps.py`).
+With `--ase` the file-based `lammps` backend of `kc.py` is also compared at the default cell height.
+The difference to the stored `fit/Ouyang/kc.csv` is printed as well, it depends on the LAMMPS build that generated that file.
+Exits with an error if a difference to LAMMPS is above `--tol` in eV/atom.
+'''
+import argparse
+import numpy as np
+import pandas as pd
+import sys
+
+import kc
+import kc_lammps
+import kc_numpy
+
+# Ouyang parameters as in `gen_kc.get_popt`
+popt = [3.416084, 20.021583, 10.9055107, 4.2756354, 1.0010836E-2, 0.8447122, 2.9360584, 14.3132588, 0]
+disregistries = [0.0, 0.16667, 0.5, 0.66667]
+
+def check_session(distances, cs):
+    '''
+    Returns the largest difference to the LAMMPS python module for every cell height in `cs`
+    '''
+    diffs = {}
+    for c in cs:
+        session = kc_lammps.LammpsSession(c=c)
+        d, disregistry = [x.ravel() for x in np.meshgrid(distances, disregistries)]
+        e_lammps = np.array([session.eval_energy(*g, *popt) for g in zip(d, disregistry)])
+        e_numpy = kc_numpy.eval_energy(d, disregistry, *popt, c=c)
+        diffs[c] = np.max(np.abs(e_lammps - e_numpy))
+    return diffs
+
+def check_ase(distances):
+    '''
+    Returns the largest difference to the file-based `lammps` backend of `kc.py`
+    '''
+    d, disregistry = [x.ravel() for x in np.meshgrid(distances, disregistries)]
+    e_lammps = np.array([kc._eval_energy(*g, *popt, keep_tmp_files=False, tmp_dir='lmp_tmp_check', backend='lammps') for g in zip(d, disregistry)])
+    e_numpy = kc_numpy.eval_energy(d, disregistry, *popt)
+    return np.max(np.abs(e_lammps - e_numpy))
+
+def check_stored(csv_name='fit/Ouyang/kc.csv'):
+    '''
+    Returns the largest difference to the stored curves of the Ouyang parameters
+    '''
+    k = pd.read_csv(csv_name)
+    e_numpy = kc_numpy.eval_energy(k['d'].values, k['disregistry'].values, *popt)
+    return np.max(np.abs(k['energy'].values - e_numpy))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--tol', default=1e-10, type=float, help='largest difference to LAMMPS in eV/atom')
+    parser.add_argument('--cs', nargs='+', default=[15, 20, 40], type=float, help='cell heights in angstrom')
+    parser.add_argument('--ase', action='store_true', help='also compare the file-based LAMMPS backend')
+    args = parser.parse_args()
+
+    distances = np.arange(2.8, 7.2 + 0.1, 0.2)
+    diffs = {f'session c={c:g}': diff for c, diff in check_session(distances, args.cs).items()}
+    if args.ase:
+        diffs['ase c=20'] = check_ase(distances)
+    for name, diff in diffs.items():
+        print(f'{name}: {diff:.3e} eV/atom')
+    print(f'stored fit/Ouyang/kc.csv: {check_stored():.3e} eV/atom')
+    if max(diffs.values()) > args.tol:
+        sys.exit(f'kc_numpy differs from LAMMPS by more than {args.tol:g} eV/atom')
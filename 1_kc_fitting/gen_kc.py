@@ -21,56 +21,57 @@ def read_hdf(fn):
         pcov = f['pcov'][()]
     return popt, pcov
 
-def gen_kc(dirname, freq=0.01):
-    '''
-    Evaluates the KC potential at four disregistries, i.e. 0.0, 0.16667, 0.5, 0.66667, and interlayer distance at every 0.01 ang.
-    Creates the output data in `kc.csv` in the given `dirname` directory.
-    '''
-    workdir = os.getcwd()
-    os.makedirs(dirname, exist_ok=True)
-    os.chdir(dirname)
+def get_dirname(method, kT):
+    return f'fit/{method}_kT{kT}' if method != 'Ouyang' else 'fit/Ouyang'
 
+def get_popt(dirname):
     if dirname == 'fit/Ouyang':
         popt = [3.416084, 20.021583, 10.9055107, 4.2756354, 1.0010836E-2, 0.8447122, 2.9360584, 14.3132588, 0]
     else:
-        popt, pcov = read_hdf('result.hdf5')
+        popt, pcov = read_hdf(f'{dirname}/result.hdf5')
+    return popt
 
-    l = []
-    for disregistry in [0.0, 0.16667, 0.5, 0.66667]:
-        for distance in np.arange(2.8, 7.2 + freq, freq):
-            distance = np.round(distance, 2)
-            print(disregistry, distance)
-            e = kc._eval_energy(distance, disregistry, *popt, keep_tmp_files=True)
-            l.append({
-                'label': dirname.replace('_', '-'),
-                'disregistry': disregistry,
-                'd': distance,
-                'energy': e,
-                'energy_inf': popt[-1],
-                })
-    k = pd.DataFrame(l)
-    k['stacking'] = k['disregistry'].map({0.0: 'AB', 0.16667: 'SP', 0.5: 'Mid', 0.66667: 'AA'})
-    k = k.sort_values(by=['label', 'disregistry', 'd'])
-    k.to_csv('kc.csv', index=False)
-    os.chdir(workdir)
+def gen_kc_batch(dirnames, freq=0.01, backend='lammps', cache=None):
+    '''
+    Evaluates the KC potential of the fits in `dirnames` at four disregistries, i.e. 0.0, 0.16667, 0.5, 0.66667, and interlayer distance at every 0.01 ang.
+    All curves are evaluated in one pass. Creates the output data in `kc.csv` in each of the given `dirnames` directories.
+    '''
+    popts = [get_popt(dirname) for dirname in dirnames]
+    labels = [dirname.replace('_', '-') for dirname in dirnames]
+    ks = kc.eval_curves(popts, labels, freq=freq, backend=backend, cache=cache)
+    for dirname, k in zip(dirnames, ks):
+        os.makedirs(dirname, exist_ok=True)
+        k.to_csv(f'{dirname}/kc.csv', index=False)
+    return ks
+
+def gen_kc(dirname, freq=0.01, backend='lammps', cache=None):
+    '''
+    Evaluates the KC potential at four disregistries, i.e. 0.0, 0.16667, 0.5, 0.66667, and interlayer distance at every 0.01 ang.
+    Creates the output data in `kc.csv` in the given `dirname` directory.
+    '''
+    k, = gen_kc_batch([dirname], freq=freq, backend=backend, cache=cache)
+    return k
+
+def label_kc(k, method, kT):
+    k['method'] = f'KC-{method}'
+    k['kT'] = int(float(kT)*1000) if kT not in ['inf', 'NA'] else kT
     return k
 
 def gen_kc_wrap(method, kT, freq=0.01):
-    dirname = f'fit/{method}_kT{kT}' if method != 'Ouyang' else 'fit/Ouyang'
+    dirname = get_dirname(method, kT)
     csv_name = f'{dirname}/kc.csv'
     if os.path.isfile(csv_name):
         k = pd.read_csv(csv_name)
     else:
         k = gen_kc(dirname, freq=freq)
-    k['method'] = f'KC-{method}'
-    k['kT'] = int(float(kT)*1000) if kT not in ['inf', 'NA'] else kT
-    return k
+    return label_kc(k, method, kT)
 
-def gen_kc_all():
+def gen_kc_all(overwrite=False, freq=0.01):
     '''
     Loops over different methods and kT to generate `kc.csv` within those directories.
+    The missing curves (or all curves if `overwrite`) are evaluated together by `gen_kc_batch`.
     '''
-    l = []
+    method_kTs = []
     for method in [
         'QMC',
         'Ouyang',
@@ -83,7 +84,16 @@ def gen_kc_all():
         else:
             kTs = [f'{kT:.3f}' for kT in np.arange(2, 21, 1)*0.001] + ['inf']
         for kT in kTs:
-            l.append(gen_kc_wrap(method, kT))
+            method_kTs.append((method, kT))
+
+    dirnames = [get_dirname(method, kT) for method, kT in method_kTs]
+    missing = [dirname for dirname in dirnames if overwrite or not os.path.isfile(f'{dirname}/kc.csv')]
+    generated = dict(zip(missing, gen_kc_batch(missing, freq=freq)))
+
+    l = []
+    for dirname, (method, kT) in zip(dirnames, method_kTs):
+        k = generated[dirname] if dirname in generated else pd.read_csv(f'{dirname}/kc.csv')
+        l.append(label_kc(k, method, kT))
     k = pd.concat(l, ignore_index=True)
     k = k.loc[:, ['method', 'kT', 'stacking', 'disregistry', 'd', 'energy', 'energy_inf']]
     print(k)
@@ -7,7 +7,7 @@ import numpy as np
 import pandas as pd
 import os
 
-import kc, read
+import kc, kc_cache, read
 
 def read_hdf(fn):
     with h5py.File(fn, 'r') as f:
@@ -26,12 +26,12 @@ def get_d_range(lim):
         }
     return d_range_map[lim]
 
-def get_r2_rms(df, popt, lim):
+def get_r2_rms(df, popt, lim, backend='lammps', cache=None):
     d_range = get_d_range(lim)
     df = df.loc[(df.d > d_range[0]) & (df.d < d_range[1]), :].reset_index(0, drop=True)
     ydata = df['energy']
 
-    residuals = ydata - kc.eval_energy(df, *popt, keep_tmp_files=False)
+    residuals = ydata - kc.eval_energy(df, *popt, keep_tmp_files=False, backend=backend, cache=cache)
     ss_res = np.sum(residuals**2)
     rms = (ss_res / len(ydata))**0.5
     ss_tot = np.sum((ydata-np.mean(ydata))**2)
@@ -42,7 +42,7 @@ def write_json(fn, d):
     with open(fn, 'w') as f:
         f.write(json.dumps(d, indent=4))
 
-def get_stats(method, kT, overwrite=False):
+def get_stats(method, kT, overwrite=False, cache=None):
     dirname = get_dirname(method, kT)
     json_file = f'{dirname}/stats.json'
     if os.path.isfile(json_file) and not overwrite:
@@ -53,7 +53,7 @@ def get_stats(method, kT, overwrite=False):
         popt, pcov = read_hdf(f'{dirname}/result.hdf5')
         stats = []
         for lim in ['min', 'far']:
-            r2, rms = get_r2_rms(df_raw, popt, lim)
+            r2, rms = get_r2_rms(df_raw, popt, lim, cache=cache)
             stat = {
                 'method': method,
                 'kT': kT,
@@ -71,16 +71,18 @@ def loop_dirs(methods, kTs):
         for kT in kTs:
             yield method, kT
 
-def collect_stats():
+def collect_stats(overwrite=False, cache=None):
     methods = ['QMC', 'DFT-D2', 'DFT-D3', 'DFT-MBD']
     kTs = np.arange(2, 21, 1).tolist() + ['inf']
     l = []
     for method, kT in loop_dirs(methods, kTs):
-        stats = get_stats(method, kT, overwrite=False)
+        stats = get_stats(method, kT, overwrite=overwrite, cache=cache)
         l += stats
     d = pd.DataFrame(l)
     os.makedirs('processed', exist_ok=True)
     d.to_csv('processed/stats.csv', index=False)
 
 if __name__ == '__main__':
-    collect_stats()
+    cache = kc_cache.EnergyCache(db_filename='processed/energy_cache.sqlite')
+    collect_stats(cache=cache)
+    print('energy cache: ', cache.stats())
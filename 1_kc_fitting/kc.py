@@ -3,6 +3,7 @@ Perform KC fitting to the raw data from either DFT or QMC
 
 Author: Kittithat Krongchon, Lucas K. Wagner
 '''
+import datetime
 import h5py
 import numpy as np
 import numpy.linalg as la
@@ -11,9 +12,11 @@ import pandas as pd
 import scipy.optimize
 import shutil
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
 from ase.calculators.lammpsrun import LAMMPS
 import gen_geom
+import kc_numpy
 import read
 
 def get_params_hybrid():
@@ -32,19 +35,19 @@ def get_params_hybrid():
     files = ['CH.rebo', 'CH_taper.KC']
     return parameters, files
 
-def get_params_kc_only():
+def get_params_kc_only(kc_filename='CH_taper.KC'):
     '''
     Defines only the KC potential
     '''
     parameters = {
         'pair_style': 'hybrid/overlay kolmogorov/crespi/full 16.0 1',
         'pair_coeff': [
-            '* * kolmogorov/crespi/full CH_taper.KC C C'
+            f'* * kolmogorov/crespi/full {kc_filename} C C'
             ],
         'atom_style': 'full',
         'specorder': ['C', 'C'],
         }
-    files = ['CH_taper.KC']
+    files = [kc_filename]
     return parameters, files
 
 def format_params(params, sep=' ', prec='.15f'):
@@ -65,117 +68,242 @@ def write_kc_potential(z0, C0, C2, C4, C, delta, lamda, A, kc_filename='CH_taper
         lines += [f'# {headers}         S     rcut', f'C C {format_params(params)} 1.0    2.0']
         f.write('\n'.join(lines))
 
-def _eval_energy(distance, disregistry, z0, C0, C2, C4, C, delta, lamda, A, E0, keep_tmp_files=True, tmp_dir='lmp_tmp'):
+def _eval_energy(distance, disregistry, z0, C0, C2, C4, C, delta, lamda, A, E0, keep_tmp_files=True, tmp_dir='lmp_tmp', backend='lammps', cache=None):
     '''
     Finds the energy for a given geometry (defined by `distance` and `disregistry`) and KC paramters
+    `backend`: `numpy` evaluates the potential in-process (`kc_numpy.py`), `lammps` runs LAMMPS as the reference,
+    `lammps_session` reuses one LAMMPS instance per process through the LAMMPS python module (`kc_lammps.py`)
+    `cache`: `kc_cache.EnergyCache` looked up before calling the backend
     '''
+    if cache is not None:
+        params = [z0, C0, C2, C4, C, delta, lamda, A, E0]
+        func = lambda idx: [_eval_energy(distance, disregistry, *params, keep_tmp_files=keep_tmp_files, tmp_dir=tmp_dir, backend=backend)]
+        return cache.eval_energy([distance], [disregistry], params, func, backend=backend)[0]
+
+    if backend == 'numpy':
+        return kc_numpy.eval_energy(distance, disregistry, z0, C0, C2, C4, C, delta, lamda, A, E0)[0]
+    elif backend == 'lammps_session':
+        import kc_lammps
+        return kc_lammps.get_session().eval_energy(distance, disregistry, z0, C0, C2, C4, C, delta, lamda, A, E0)
+
     atoms = gen_geom.create_graphene_geom(distance, disregistry)
     atoms.set_array('mol-id', np.array([0, 0, 1, 1]))
 
-    write_kc_potential(z0, C0, C2, C4, C, delta, lamda, A)
-    parameters, files = get_params_kc_only()
-    # lammps_options = '' if keep_tmp_files else '-echo log -screen none -log /dev/stdout'
-    atoms.calc = LAMMPS(files=files, keep_tmp_files=True, tmp_dir=tmp_dir, lammps_options='', **parameters)
+    # the potential file and the LAMMPS log live in `tmp_dir`, so runs with different `tmp_dir` do not share any file
+    tmp_dir = os.path.abspath(tmp_dir)
+    os.makedirs(tmp_dir, exist_ok=True)
+    kc_filename = os.path.join(tmp_dir, 'CH_taper.KC')
+    write_kc_potential(z0, C0, C2, C4, C, delta, lamda, A, kc_filename=kc_filename)
+    parameters, files = get_params_kc_only(kc_filename)
+    lammps_options = f'-log {os.path.join(tmp_dir, "log.lammps")}'
+    atoms.calc = LAMMPS(keep_tmp_files=True, tmp_dir=tmp_dir, lammps_options=lammps_options, **parameters)
     e = atoms.get_potential_energy()/len(atoms) + E0
     if not keep_tmp_files:
         shutil.rmtree(tmp_dir, ignore_errors=True)
-        for fn in files:
-            if os.path.isfile(fn):
-                os.remove(fn)
-        lmp_output = 'log.lammps'
-        if os.path.isfile(lmp_output):
-            os.remove(lmp_output)
     return e
 
-def eval_energy(df, z0, C0, C2, C4, C, delta, lamda, A, E0, keep_tmp_files=True):
+def _eval_energy_worker(distance, disregistry, params, keep_tmp_files, tmp_dir, backend):
+    '''
+    Evaluates one geometry in a worker process of `get_executor`, using a scratch directory owned by the worker
+    '''
+    tmp_dir = f'{tmp_dir}_{os.getpid()}'
+    return _eval_energy(distance, disregistry, *params, keep_tmp_files=keep_tmp_files, tmp_dir=tmp_dir, backend=backend)
+
+_executor = None
+_executor_nworkers = 0
+def get_executor(nworkers):
+    '''
+    Returns a process pool with `nworkers` workers, which is kept alive between residual evaluations
+    '''
+    global _executor, _executor_nworkers
+    if _executor_nworkers != nworkers:
+        if _executor is not None:
+            _executor.shutdown()
+        _executor = ProcessPoolExecutor(max_workers=nworkers)
+        _executor_nworkers = nworkers
+    return _executor
+
+def eval_energy(df, z0, C0, C2, C4, C, delta, lamda, A, E0, keep_tmp_files=True, tmp_dir='lmp_tmp', backend='lammps', nworkers=1, cache=None):
     '''
     Finds the energy for a given geometry (in `df`) and KC paramters
+    Only the `lammps` backend touches the disk, in `tmp_dir`. The other backends never write to or change the working directory
+    `nworkers` > 1 distributes the geometries over a process pool for the LAMMPS backends, the results are in the order of `df`
+    `cache`: `kc_cache.EnergyCache`, only the geometries missing from the cache are evaluated by the backend
     '''
-    tmp_dir = 'lmp_tmp'
-    shutil.rmtree(tmp_dir, ignore_errors=True)
+    if cache is not None:
+        params = [z0, C0, C2, C4, C, delta, lamda, A, E0]
+        func = lambda idx: eval_energy(df.iloc[idx], *params, keep_tmp_files=keep_tmp_files, tmp_dir=tmp_dir, backend=backend, nworkers=nworkers)
+        return cache.eval_energy(df['d'].values, df['disregistry'].values, params, func, backend=backend)
+
+    if backend == 'numpy':
+        return kc_numpy.eval_energy(df['d'].values, df['disregistry'].values, z0, C0, C2, C4, C, delta, lamda, A, E0)
+
+    if nworkers > 1:
+        n = len(df)
+        params = [z0, C0, C2, C4, C, delta, lamda, A, E0]
+        energy = get_executor(nworkers).map(_eval_energy_worker, df['d'], df['disregistry'],
+            [params]*n, [keep_tmp_files]*n, [tmp_dir]*n, [backend]*n, chunksize=max(1, n//(4*nworkers)))
+        return np.array(list(energy))
+
+    if backend == 'lammps':
+        shutil.rmtree(tmp_dir, ignore_errors=True)
 
     energy = []
     for _, row in df.iterrows():
-        e = _eval_energy(row['d'], row['disregistry'], z0, C0, C2, C4, C, delta, lamda, A, E0, keep_tmp_files=keep_tmp_files, tmp_dir=tmp_dir)
+        e = _eval_energy(row['d'], row['disregistry'], z0, C0, C2, C4, C, delta, lamda, A, E0, keep_tmp_files=keep_tmp_files, tmp_dir=tmp_dir, backend=backend)
         energy.append(e)
 
     en =  np.array(energy)
     return en
 
-en_prev = 0
-def eval_energy_track(df, z0, C0, C2, C4, C, delta, lamda, A, E0):
+def get_curve_geometry(freq=0.01):
+    '''
+    Returns the geometries of the KC curves, i.e. the disregistries 0.0, 0.16667, 0.5, 0.66667 and interlayer distance at every `freq` ang
+    '''
+    disregistries = [0.0, 0.16667, 0.5, 0.66667]
+    distances = np.round(np.arange(2.8, 7.2 + freq, freq), 2)
+    df = pd.DataFrame({
+        'disregistry': np.repeat(disregistries, len(distances)),
+        'd': np.tile(distances, len(disregistries)),
+        })
+    return df
+
+def eval_curves(popts, labels, freq=0.01, backend='lammps', nworkers=1, cache=None):
+    '''
+    Evaluates the KC curves for every row of parameters in `popts`
+    Returns a list of data frames in the format of `kc.csv`, labeled by `labels`
+    '''
+    geom = get_curve_geometry(freq)
+    if backend == 'numpy' and cache is None:
+        energies = kc_numpy.eval_energy_batch(geom['d'].values, geom['disregistry'].values, popts)
+    else:
+        energies = [eval_energy(geom, *popt, backend=backend, nworkers=nworkers, cache=cache) for popt in popts]
+
+    l = []
+    for label, popt, energy in zip(labels, popts, energies):
+        k = geom.copy()
+        k.insert(0, 'label', label)
+        k['energy'] = energy
+        k['energy_inf'] = popt[-1]
+        k['stacking'] = k['disregistry'].map({0.0: 'AB', 0.16667: 'SP', 0.5: 'Mid', 0.66667: 'AA'})
+        l.append(k)
+    return l
+
+def eval_jacobian(df, z0, C0, C2, C4, C, delta, lamda, A, E0):
+    '''
+    Finds the analytic derivatives of the energy for a given geometry (in `df`) with respect to the KC parameters
+    '''
+    return kc_numpy.eval_jacobian(df['d'].values, df['disregistry'].values, z0, C0, C2, C4, C, delta, lamda, A, E0)
+
+_track = {'en_prev': 0}
+def eval_energy_track(df, z0, C0, C2, C4, C, delta, lamda, A, E0, tmp_dir='lmp_tmp', backend='lammps', nworkers=1, cache=None, track=None):
     '''
     Finds the energy for a given geometry (in `df`) and KC paramters
-    Also keep track of the energy in the previous iteration
+    Also keep track of the energy in the previous iteration in `track`, which is a separate dictionary for each concurrent fit
     '''
-    global en_prev
-    en = eval_energy(df, z0, C0, C2, C4, C, delta, lamda, A, E0, keep_tmp_files=True)
-    en_diff = la.norm(en - en_prev)
-    en_prev = en.copy()
+    if track is None:
+        track = _track
+    en = eval_energy(df, z0, C0, C2, C4, C, delta, lamda, A, E0, keep_tmp_files=True, tmp_dir=tmp_dir, backend=backend, nworkers=nworkers, cache=cache)
+    en_diff = la.norm(en - track['en_prev'])
+    track['en_prev'] = en.copy()
     params = [z0, C0, C2, C4, C, delta, lamda, A, E0]
     print(f'{en_diff: 25.15f} ' + format_params(params, prec=' 18.15f'))
     return en
 
-def fit(method='QMC', kT='inf', model_id=0, starting_guess='old_fit'):
+def get_kT_str(kT):
+    return 'inf' if kT == 'inf' else f'{float(kT):.3f}'
+
+def get_weights(ydata, kT):
     '''
-    `kT`: temperature in the boltzmann factor, used to assign weights
-    bound all params = [0, np.inf]
+    Returns the weights and the corresponding `sigma` for `curve_fit`
     '''
-    now = datetime.datetime.now()
-    print(now)
-    df = read.read_data(method)
-    ydata = np.random.normal(loc=df['energy'], scale=df['energy_err'])
-
-    dir_prefix = f'fit_bootstrap/{method}_{int(model_id):02}_kT'
     if kT == 'inf':
-        kT_str = 'inf'
         weights = np.nan
         sigma = None
     else:
         # set weights such that points near the minimum (lower energy) have more weights, e.g. kT=0.002, 0.004, 0.010
-        kT = float(kT)
-        kT_str = f'{kT:.3f}'
-        weights = np.exp(-(ydata-ydata.min())/kT)
+        weights = np.exp(-(ydata-ydata.min())/float(kT))
         sigma = 1/np.sqrt(weights)
-    dirname = dir_prefix + kT_str
-    workdir = os.getcwd()
-    os.makedirs(dirname, exist_ok=True)
-    os.chdir(dirname)
+    return weights, sigma
 
+def get_starting_guess(df, method, kT, starting_guess='old_fit', workdir='.'):
+    '''
+    Returns the starting parameters and the energy at infinite interlayer spacing around which E0 is bounded
+    '''
     if starting_guess == 'ouyang':
         print('starting guess from Ouyang, Mandelli, Urbakh, and Hod, Nanoserpents: Graphene Nanoribbon Motion on Two-Dimensional Hexagonal Materials, Nano letters, 2018')
         energy_inf = read.get_energy_inf(df)
         p0 = [3.416084, 20.021583, 10.9055107, 4.2756354, 1.0010836E-2, 0.8447122, 2.9360584, 14.3132588, energy_inf]
     elif starting_guess == 'old_fit':
         print('use a starting guess from the old fit')
-        hdf_filename = os.path.join(workdir, f'fit/{method}_kT{kT_str}/result.hdf5')
-        with h5py.File(fn, 'r') as f:
+        hdf_filename = os.path.join(workdir, f'fit/{method}_kT{get_kT_str(kT)}/result.hdf5')
+        with h5py.File(hdf_filename, 'r') as f:
             p0 = f['popt'][()]
         print('starting guess parameters: ', p0)
         energy_inf = p0[-1]
+    return p0, energy_inf
 
+def fit_params(df, ydata, p0, energy_inf, sigma=None, tmp_dir='lmp_tmp', backend='lammps', nworkers=1, cache=None, verbose=True, full_output=False):
+    '''
+    Fits the KC parameters to `ydata` starting from `p0`
+    bound all params = [0, np.inf], and E0 within 0.01 eV of `energy_inf`
+    `full_output`: also returns the `infodict` of `curve_fit`, e.g. the number of function evaluations `nfev`
+    The fit keeps no global state, so several fits with the `numpy` backend can run concurrently in one process
+    '''
     energy_range = 0.01
-    popt, pcov = scipy.optimize.curve_fit(eval_energy_track, df, ydata, p0=p0, method='trf', sigma=sigma,
+    if verbose:
+        track = {'en_prev': 0}
+        func = lambda df, *params: eval_energy_track(df, *params, tmp_dir=tmp_dir, backend=backend, nworkers=nworkers, cache=cache, track=track)
+    else:
+        func = lambda df, *params: eval_energy(df, *params, tmp_dir=tmp_dir, backend=backend, nworkers=nworkers, cache=cache)
+    jac = eval_jacobian if backend == 'numpy' else '2-point'
+    popt, pcov, infodict, mesg, ier = scipy.optimize.curve_fit(func, df, ydata, p0=p0, method='trf', sigma=sigma, jac=jac,
         bounds = (
             [0, 0, 0, 0, 0, 0, 0, 0, energy_inf - energy_range],
             [np.inf, np.inf, np.inf, np.inf, np.inf, np.inf, np.inf, np.inf, energy_inf + energy_range]
-            )
+            ),
+        full_output=True
         )
+    if full_output:
+        return popt, pcov, infodict
+    return popt, pcov
+
+def fit(method='QMC', kT='inf', model_id=0, starting_guess='old_fit', backend='lammps', nworkers=1, cache=None):
+    '''
+    `kT`: temperature in the boltzmann factor, used to assign weights
+    `backend`: `numpy`, `lammps` or `lammps_session`, see `_eval_energy`. The `numpy` backend also provides the analytic jacobian to the optimizer
+    `nworkers`: number of processes evaluating the LAMMPS backends, see `eval_energy`
+    `cache`: `kc_cache.EnergyCache` in front of the backend
+    '''
+    now = datetime.datetime.now()
+    print(now)
+    df = read.read_data(method)
+    ydata = np.random.normal(loc=df['energy'], scale=df['energy_err'])
+    weights, sigma = get_weights(ydata, kT)
+    p0, energy_inf = get_starting_guess(df, method, kT, starting_guess=starting_guess)
+
+    dirname = f'fit_bootstrap/{method}_{int(model_id):02}_kT{get_kT_str(kT)}'
+    os.makedirs(dirname, exist_ok=True)
+
+    tmp_dir = os.path.join(dirname, 'lmp_tmp')
+    popt, pcov = fit_params(df, ydata, p0, energy_inf, sigma=sigma, tmp_dir=tmp_dir, backend=backend, nworkers=nworkers, cache=cache)
 
-    with h5py.File('result.hdf5', 'w') as f:
+    with h5py.File(os.path.join(dirname, 'result.hdf5'), 'w') as f:
         f['popt'] = popt
         f['pcov'] = pcov
         f['weights'] = weights
 
-    os.chdir(workdir)
+    if cache is not None:
+        print('energy cache: ', cache.stats())
     now = datetime.datetime.now()
     print(now)
 
 if __name__ == '__main__':
-    import datetime
     parser = argparse.ArgumentParser()
     parser.add_argument('-kT', default='inf')
     parser.add_argument('--method', default='QMC')
     parser.add_argument('--model_id', default=0)
+    parser.add_argument('--backend', default='lammps', choices=['numpy', 'lammps', 'lammps_session'])
+    parser.add_argument('--nworkers', default=1, type=int)
     args = parser.parse_args()
-    fit(method=args.method, kT=args.kT, model_id=args.model_id)
+    fit(method=args.method, kT=args.kT, model_id=args.model_id, backend=args.backend, nworkers=args.nworkers)
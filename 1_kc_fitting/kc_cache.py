@@ -0,0 +1,111 @@
+'''
+Cache of KC energies keyed by the parameters and the geometry
+
+Entries are kept in a bounded in-memory LRU and optionally in an SQLite file, so that
+repeated evaluations within a fit, across `min`/`far` ranges and across script invocations are looked up instead of recomputed.
+The key is a hash of the backend, the cutoff `rcut`, the KC parameters and (`distance`, `disregistry`) formatted to `ndigits` significant digits,
+so energies of different backends or cutoffs sharing one SQLite file are never mixed.
+'''
+import collections
+import hashlib
+import numpy as np
+import sqlite3
+
+def get_key(params, distance, disregistry, backend='lammps', rcut=16.0, ndigits=12):
+    s = f'{backend} {rcut:.{ndigits}g} ' + ' '.join(f'{v:.{ndigits}g}' for v in list(params) + [distance, disregistry])
+    return hashlib.sha1(s.encode()).hexdigest()
+
+class EnergyCache:
+    def __init__(self, maxsize=100000, db_filename=None, ndigits=12):
+        '''
+        `maxsize`: number of energies kept in memory
+        `db_filename`: SQLite file of the on-disk tier, None to keep the cache in memory only
+        '''
+        self.maxsize = maxsize
+        self.ndigits = ndigits
+        self.lru = collections.OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        if db_filename is not None:
+            self.db = sqlite3.connect(db_filename)
+            self.db.execute('CREATE TABLE IF NOT EXISTS energy (key TEXT PRIMARY KEY, value REAL)')
+
+    def _put_lru(self, key, value):
+        self.lru[key] = value
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.maxsize:
+            self.lru.popitem(last=False)
+
+    def _get_disk(self, keys):
+        found = {}
+        if self.db is None:
+            return found
+        chunk = 500
+        for i in range(0, len(keys), chunk):
+            sub = keys[i:i + chunk]
+            query = f'SELECT key, value FROM energy WHERE key IN ({",".join("?"*len(sub))})'
+            found.update(self.db.execute(query, sub).fetchall())
+        return found
+
+    def _put_disk(self, items):
+        if self.db is None:
+            return
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO energy VALUES (?, ?)', items)
+
+    def eval_energy(self, distances, disregistries, params, func, backend='lammps', rcut=16.0):
+        '''
+        Returns the energies for arrays of `distances` and `disregistries`.
+        Only the geometries that are not cached are passed to `func(idx)`, which returns their energies,
+        where `idx` are their indices in `distances`.
+        `backend`, `rcut`: the backend and cutoff of `func`, which are part of the key
+        '''
+        keys = [get_key(params, d, s, backend, rcut, self.ndigits) for d, s in zip(distances, disregistries)]
+        energy = np.empty(len(keys))
+        missing = []
+        for i, key in enumerate(keys):
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                energy[i] = self.lru[key]
+                self.hits += 1
+            else:
+                missing.append(i)
+
+        found = self._get_disk([keys[i] for i in missing])
+        idx = []
+        for i in missing:
+            if keys[i] in found:
+                energy[i] = found[keys[i]]
+                self._put_lru(keys[i], energy[i])
+                self.disk_hits += 1
+            else:
+                idx.append(i)
+
+        if idx:
+            self.misses += len(idx)
+            energy[idx] = func(np.array(idx))
+            for i in idx:
+                self._put_lru(keys[i], energy[i])
+            self._put_disk([(keys[i], energy[i]) for i in idx])
+        return energy
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'size': len(self.lru),
+            }
+
+    def clear(self):
+        self.lru.clear()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
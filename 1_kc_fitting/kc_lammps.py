@@ -0,0 +1,92 @@
+'''
+Evaluate the KC potential with a LAMMPS instance that stays alive between geometries
+
+The 4-atom cell from `gen_geom.py` is created once. For every geometry the atoms are moved in place with `scatter_atoms`,
+the potential file is rewritten and reloaded with `pair_coeff` only when the KC parameters change,
+and the energy is read from `thermo_pe` after `run 0`.
+Requires the LAMMPS python module built with the INTERLAYER package.
+'''
+import ctypes
+import numpy as np
+import os
+import tempfile
+
+import gen_geom
+import kc
+
+class LammpsSession:
+    def __init__(self, a=2.46, c=20, tmp_dir=None):
+        from lammps import lammps, LMP_STYLE_GLOBAL, LMP_TYPE_SCALAR
+        self.a = a
+        self.c = c
+        self.cell = np.array(gen_geom.get_lattice_vectors(a, c))
+        self.tmp_dir = tempfile.mkdtemp(prefix='lmp_session_') if tmp_dir is None else tmp_dir
+        self.kc_filename = os.path.join(self.tmp_dir, 'CH_taper.KC')
+        self.params = None
+        self.extract_args = (LMP_STYLE_GLOBAL, LMP_TYPE_SCALAR)
+
+        self.lmp = lammps(cmdargs=['-log', 'none', '-screen', 'none', '-nocite'])
+        basis = self.wrap(np.array(gen_geom.get_basis(a, 3.4, c, 0.0)))
+        xy = self.cell[1, 0]
+        self.lmp.commands_list([
+            'units metal',
+            'atom_style full',
+            'atom_modify map array sort 0 0.0',
+            'boundary p p p',
+            f'region box prism 0 {self.cell[0, 0]} 0 {self.cell[1, 1]} 0 {c} {xy} 0 0 units box',
+            'create_box 2 box',
+            'mass * 12.011',
+            ] + [
+            f'create_atoms {1 if i < 2 else 2} single {x} {y} {z} units box'
+            for i, (x, y, z) in enumerate(basis)
+            ] + [
+            'group bottom id 1 2',
+            'group top id 3 4',
+            'set group bottom mol 1',
+            'set group top mol 2',
+            'pair_style hybrid/overlay kolmogorov/crespi/full 16.0 1',
+            ])
+
+    def wrap(self, positions):
+        '''
+        Wraps the in-plane coordinates back into the cell so that LAMMPS does not lose atoms
+        '''
+        frac = positions @ np.linalg.inv(self.cell)
+        frac[:, :2] %= 1
+        return frac @ self.cell
+
+    def set_params(self, z0, C0, C2, C4, C, delta, lamda, A):
+        params = (z0, C0, C2, C4, C, delta, lamda, A)
+        if params == self.params:
+            return
+        kc.write_kc_potential(*params, kc_filename=self.kc_filename)
+        self.lmp.command(f'pair_coeff * * kolmogorov/crespi/full {self.kc_filename} C C')
+        self.params = params
+
+    def set_geometry(self, distance, disregistry):
+        basis = self.wrap(np.array(gen_geom.get_basis(self.a, distance, self.c, disregistry)))
+        x = (ctypes.c_double*basis.size)(*basis.ravel())
+        self.lmp.scatter_atoms('x', 1, 3, x)
+
+    def eval_energy(self, distance, disregistry, z0, C0, C2, C4, C, delta, lamda, A, E0):
+        '''
+        Finds the energy per atom for a given geometry and KC parameters
+        '''
+        self.set_params(z0, C0, C2, C4, C, delta, lamda, A)
+        self.set_geometry(distance, disregistry)
+        self.lmp.command('run 0')
+        natoms = 4
+        return self.lmp.extract_compute('thermo_pe', *self.extract_args)/natoms + E0
+
+    def close(self):
+        self.lmp.close()
+
+_session = None
+def get_session():
+    '''
+    Returns the LAMMPS session of this process, which is created on the first call
+    '''
+    global _session
+    if _session is None:
+        _session = LammpsSession()
+    return _session
@@ -0,0 +1,118 @@
+'''
+Evaluate the Kolmogorov-Crespi potential (LAMMPS `kolmogorov/crespi/full` with taper) in NumPy
+
+The interlayer energy of the 4-atom bilayer cell from `gen_geom.py` is summed over all periodic images
+of the top layer within the cutoff, so no LAMMPS process is needed to evaluate the fitting data.
+Both layers are flat, so every normal points along z and the transverse distance `rho` is the in-plane distance.
+`check_kc_numpy.py` compares it with the installed LAMMPS, which stays the default backend of `kc.py`.
+'''
+import functools
+import numpy as np
+
+import gen_geom
+
+def calc_tap(r, rcut):
+    '''
+    Taper function of `kolmogorov/crespi/full`, which goes smoothly from 1 at r = 0 to 0 at r = `rcut`
+    '''
+    x = r/rcut
+    tap = 20*x**7 - 70*x**6 + 84*x**5 - 35*x**4 + 1
+    return np.where(x < 1, tap, 0.0)
+
+@functools.lru_cache(maxsize=16)
+def _get_pair_geometry(distances, disregistries, a, c, rcut):
+    nmax = int(np.ceil(rcut/(a*3**0.5/2))) + 1
+    n = np.arange(-nmax, nmax + 1)
+    n1, n2, n3 = np.meshgrid(n, n, [-1, 0, 1], indexing='ij')
+    shifts = np.stack([n1.ravel(), n2.ravel(), n3.ravel()], axis=1) @ np.array(gen_geom.get_lattice_vectors(a, c))
+
+    r_l = []
+    rho_l = []
+    for distance, disregistry in zip(distances, disregistries):
+        basis = np.array(gen_geom.get_basis(a, distance, c, disregistry))
+        # vectors from each bottom-layer atom to every periodic image of each top-layer atom
+        vec = basis[None, 2:, None, :] + shifts[None, None, :, :] - basis[:2, None, None, :]
+        vec = vec.reshape(-1, 3)
+        r_l.append(np.linalg.norm(vec, axis=1))
+        rho_l.append(np.linalg.norm(vec[:, :2], axis=1))
+    r = np.array(r_l)
+    rho = np.array(rho_l)
+
+    # drop the pairs that are outside the cutoff for every geometry
+    mask = np.any(r < rcut, axis=0)
+    return r[:, mask], rho[:, mask]
+
+def get_pair_geometry(distance, disregistry, a=2.46, c=20, rcut=16.0):
+    '''
+    Returns the interlayer distances `r` and transverse distances `rho` of every bottom-top pair,
+    each with shape (number of geometries, number of pairs)
+    '''
+    distances = tuple(np.atleast_1d(distance).astype(float).tolist())
+    disregistries = tuple(np.atleast_1d(disregistry).astype(float).tolist())
+    return _get_pair_geometry(distances, disregistries, a, c, rcut)
+
+def get_cell_energy(r, rho, tap, z0, C0, C2, C4, C, delta, lamda, A):
+    '''
+    Sums the tapered pair energies (eV) over the last axis of `r` and `rho`, the parameters broadcast against the other axes
+    '''
+    rdsq = (rho/delta)**2
+    frho = np.exp(-rdsq)*(C0 + C2*rdsq + C4*rdsq**2)
+    # each pair enters twice in the full neighbor list, once with the normal of each atom
+    erep = np.exp(-lamda*(r - z0))*(C + 2*frho)
+    evdw = -A*(z0/r)**6
+    return np.sum(tap*(erep + evdw), axis=-1)*1e-3
+
+def eval_energy(distance, disregistry, z0, C0, C2, C4, C, delta, lamda, A, E0, rcut=16.0, c=20):
+    '''
+    Finds the energy per atom (eV) for arrays of `distance` and `disregistry` and the KC parameters (in meV as in `CH_taper.KC`)
+    `c`: height of the cell, whose images along z are within the cutoff at large `distance`
+    '''
+    r, rho = get_pair_geometry(distance, disregistry, c=c, rcut=rcut)
+    natoms = 4
+    return get_cell_energy(r, rho, calc_tap(r, rcut), z0, C0, C2, C4, C, delta, lamda, A)/natoms + E0
+
+def eval_energy_batch(distance, disregistry, popts, rcut=16.0, max_size=2**23):
+    '''
+    Finds the energy per atom for every row of KC parameters in `popts`, with shape (number of fits, number of geometries)
+    The pair geometry is built once and the parameters are broadcast over it, in blocks of fits of at most `max_size` pair terms
+    '''
+    r, rho = get_pair_geometry(distance, disregistry, rcut=rcut)
+    tap = calc_tap(r, rcut)
+    popts = np.atleast_2d(np.asarray(popts, dtype=float))
+    nfits = max(1, max_size//r.size)
+    natoms = 4
+    energies = []
+    for start in range(0, len(popts), nfits):
+        z0, C0, C2, C4, C, delta, lamda, A, E0 = popts[start:start + nfits, :, None, None].transpose(1, 0, 2, 3)
+        energies.append(get_cell_energy(r, rho, tap, z0, C0, C2, C4, C, delta, lamda, A)/natoms + E0[:, :, 0])
+    return np.concatenate(energies)
+
+def eval_jacobian(distance, disregistry, z0, C0, C2, C4, C, delta, lamda, A, E0, rcut=16.0):
+    '''
+    Finds the derivatives of the energy per atom from `eval_energy` with respect to
+    z0, C0, C2, C4, C, delta, lambda, A and E0, in this order along the last axis
+    '''
+    r, rho = get_pair_geometry(distance, disregistry, rcut=rcut)
+    tap = calc_tap(r, rcut)
+    rdsq = (rho/delta)**2
+    exp1 = np.exp(-rdsq)
+    frho = exp1*(C0 + C2*rdsq + C4*rdsq**2)
+    exp0 = np.exp(-lamda*(r - z0))
+    erep = exp0*(C + 2*frho)
+    z0r6 = (z0/r)**6
+
+    dfrho_drdsq = exp1*(C2 + 2*C4*rdsq) - frho
+    derivs = [
+        lamda*erep - 6*A*z0r6/z0, # z0
+        2*exp0*exp1, # C0
+        2*exp0*exp1*rdsq, # C2
+        2*exp0*exp1*rdsq**2, # C4
+        exp0, # C
+        2*exp0*dfrho_drdsq*(-2*rdsq/delta), # delta
+        -(r - z0)*erep, # lambda
+        -z0r6, # A
+        ]
+    natoms = 4
+    jac = [np.sum(tap*deriv, axis=1)*1e-3/natoms for deriv in derivs]
+    jac.append(np.ones(r.shape[0])) # E0
+    return np.stack(jac, axis=1)
@@ -76,6 +76,21 @@ def fit_multi_kT():
             ]:
             submit(method=method, kT=kT, queue='secondary')
 
+def fit_sweep_kT():
+    '''
+    Fits all kT of a method in one job with `sweep_kT.py`
+    '''
+    for method in [
+        'QMC',
+        'DFT-D2',
+        'DFT-D3',
+        'DFT-MBD'
+        ]:
+        dirname = f'fit/{method}_sweep'
+        os.makedirs(dirname, exist_ok=True)
+        cmd = f'python -u sweep_kT.py --method {method}'
+        submit_slurm(dirname, cmd, queue='secondary')
+
 def fit_bootstrap(method='QMC'):
     for model_id in range(20):
         for kT in [
@@ -84,6 +99,16 @@ def fit_bootstrap(method='QMC'):
             ]:
             submit(method=method, kT=kT, model_id=model_id, queue='secondary')
 
+def fit_bootstrap_pool(method='QMC', nmodels=20):
+    '''
+    Fits all bootstrap models of a kT in one job with `bootstrap_kc_fit.py`
+    '''
+    for kT in ['inf', '0.004']:
+        dirname = f'fit_bootstrap/{method}_kT{kT}'
+        os.makedirs(dirname, exist_ok=True)
+        cmd = f'python -u bootstrap_kc_fit.py --method {method} -kT {kT} --nmodels {nmodels} --nworkers 20'
+        submit_slurm(dirname, cmd, queue='secondary')
+
 def submit_gen_kc():
     cmd = f'python -u bootstrap_kc.py'
     submit_slurm('.', cmd, queue='qmchamm')
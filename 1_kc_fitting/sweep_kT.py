@@ -0,0 +1,96 @@
+'''
+Fits the weighted KC models of one method for a sequence of kT values by continuation,
+i.e. each fit starts from the optimum of the previous kT, since neighboring kT values have nearly identical optima,
+except for the energy at infinite spacing E0, which is restarted from the guess of every kT.
+All kT values share one resampled data set and one energy cache, and the results are stored in `fit/{method}_sweep.hdf5`.
+'''
+import argparse
+import datetime
+import h5py
+import numpy as np
+import os
+
+import kc
+import kc_cache
+import read
+
+def get_kTs():
+    return [f'{kT:.3f}' for kT in np.arange(2, 21)*0.001] + ['inf']
+
+def get_hdf_filename(method):
+    return f'fit/{method}_sweep.hdf5'
+
+def run_sweep(method='QMC', kTs=None, starting_guess='old_fit', seed=0, backend='lammps', nworkers=1, cache=None):
+    '''
+    Fits `kTs` in the given order. The first kT starts from `starting_guess`, the others from the previous optimum,
+    except for E0 and its bounds, which are taken from `starting_guess` of every kT as in `kc.fit`.
+    A new energy cache is created for the LAMMPS backends unless `cache` is given.
+    '''
+    print(datetime.datetime.now())
+    kTs = get_kTs() if kTs is None else [kc.get_kT_str(kT) for kT in kTs]
+    if cache is None and backend != 'numpy':
+        cache = kc_cache.EnergyCache()
+
+    df = read.read_data(method)
+    rng = np.random.default_rng(seed)
+    ydata = rng.normal(loc=df['energy'], scale=df['energy_err'])
+
+    l = []
+    for i, kT in enumerate(kTs):
+        # energy_inf and the start of E0 belong to this kT, only the other parameters continue from the previous fit
+        p0_kT, energy_inf = kc.get_starting_guess(df, method, kT, starting_guess=starting_guess)
+        p0 = p0_kT if i == 0 else np.append(popt[:-1], p0_kT[-1])
+        weights, sigma = kc.get_weights(ydata, kT)
+        popt, pcov, infodict = kc.fit_params(df, ydata, p0, energy_inf, sigma=sigma, backend=backend,
+            nworkers=nworkers, cache=cache, verbose=False, full_output=True)
+        print(f'kT = {kT}: nfev = {infodict["nfev"]:4d} ' + kc.format_params(popt, prec=' 18.15f'))
+        l.append({'popt': popt, 'pcov': pcov, 'weights': weights*np.ones(len(df)), 'nfev': infodict['nfev']})
+
+    with h5py.File(get_hdf_filename(method), 'w') as f:
+        f.attrs['method'] = method
+        f.attrs['seed'] = seed
+        f['kT'] = np.array(kTs, dtype='S')
+        f['ydata'] = ydata
+        for key in ['popt', 'pcov', 'weights', 'nfev']:
+            f[key] = np.array([result[key] for result in l])
+
+    print(f'total nfev = {sum(result["nfev"] for result in l)}')
+    if cache is not None:
+        print('energy cache: ', cache.stats())
+    print(datetime.datetime.now())
+
+def read_sweep(method):
+    '''
+    Returns a dictionary from kT to (popt, pcov)
+    '''
+    with h5py.File(get_hdf_filename(method), 'r') as f:
+        kTs = [kT.decode() for kT in f['kT'][()]]
+        popt = f['popt'][()]
+        pcov = f['pcov'][()]
+    return {kT: (popt[i], pcov[i]) for i, kT in enumerate(kTs)}
+
+def export_sweep(method, overwrite=False):
+    '''
+    Writes `fit/{method}_kT{kT}/result.hdf5` from the sweep file, which is read by `gen_kc.py` and `gen_stats.py`
+    '''
+    with h5py.File(get_hdf_filename(method), 'r') as f:
+        kTs = [kT.decode() for kT in f['kT'][()]]
+        for i, kT in enumerate(kTs):
+            hdf_filename = f'fit/{method}_kT{kT}/result.hdf5'
+            if os.path.isfile(hdf_filename) and not overwrite:
+                continue
+            os.makedirs(os.path.dirname(hdf_filename), exist_ok=True)
+            with h5py.File(hdf_filename, 'w') as g:
+                g['popt'] = f['popt'][i]
+                g['pcov'] = f['pcov'][i]
+                g['weights'] = f['weights'][i] if kT != 'inf' else np.nan
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--method', default='QMC')
+    parser.add_argument('--starting_guess', default='old_fit', choices=['old_fit', 'ouyang'])
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--backend', default='lammps', choices=['numpy', 'lammps', 'lammps_session'])
+    parser.add_argument('--nworkers', default=1, type=int)
+    args = parser.parse_args()
+    run_sweep(method=args.method, starting_guess=args.starting_guess, seed=args.seed, backend=args.backend, nworkers=args.nworkers)
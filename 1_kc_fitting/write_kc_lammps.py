@@ -9,18 +9,16 @@ import kc
 
 if __name__ == '__main__':
     kTs = [f'{kT:.3f}' for kT in np.arange(2, 21)*0.001] + ['inf']
-    workdir = os.getcwd()
     for kT in kTs:
         dirname = f'fit/QMC_kT{kT}'
         print(dirname)
-        os.chdir(dirname)
 
-        if os.path.isfile('CH_taper.KC'):
-            os.remove('CH_taper.KC')
-        with h5py.File('result.hdf5', 'r') as f:
+        kc_filename = os.path.join(dirname, 'CH_taper.KC')
+        if os.path.isfile(kc_filename):
+            os.remove(kc_filename)
+        with h5py.File(os.path.join(dirname, 'result.hdf5'), 'r') as f:
             popt = f['popt'][()]
 
         params = popt[:-1]
         print(params)
-        kc.write_kc_potential(*params, kc_filename='CC_QMC.KC', cite=True)
-        os.chdir(workdir)
+        kc.write_kc_potential(*params, kc_filename=os.path.join(dirname, 'CC_QMC.KC'), cite=True)
@@ -0,0 +1,109 @@
+'''
+Catalogue of commensurate twist angles of bilayer graphene and batch generation of their starting geometries
+
+A pair (m, n) with m > n >= 1 and gcd(m, n) = 1 gives the twist angle cos(theta) = (m^2 + 4mn + n^2)/(2(m^2 + mn + n^2)).
+Pairs with m - n divisible by 3 are skipped, since they give the same structures as other pairs at 60 - theta.
+The hexagonal moire cell then has 4(m^2 + mn + n^2) atoms, and the rectangular cell of `geom.py`, which is built for n = m - 1, has twice as many.
+'''
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import math
+import numpy as np
+import os
+import pandas as pd
+
+import geom
+
+def get_angle(m, n):
+    '''
+    Returns the twist angle in degrees
+    '''
+    return np.degrees(np.arccos((m**2 + 4*m*n + n**2)/(2*(m**2 + m*n + n**2))))
+
+def get_moire_latvecs(m, n, a=2.46):
+    '''
+    Returns the moire lattice vectors t1 = m a1 + n a2 and t2 = -n a1 + (m + n) a2 of the unrotated layer
+    '''
+    a1 = a*np.array([1, 0])
+    a2 = a*np.array([1/2, np.sqrt(3)/2])
+    return np.array([m*a1 + n*a2, -n*a1 + (m + n)*a2])
+
+def get_dirname(angle):
+    '''
+    Directory name of an angle as used by the relaxations, e.g. 0.98743 -> 0-99
+    '''
+    return f'{angle:.2f}'.replace('.', '-')
+
+def get_catalogue(max_atoms=100000, a=2.46):
+    '''
+    Returns a table of the commensurate angles whose hexagonal moire cell has at most `max_atoms` atoms, sorted by decreasing angle
+    `rect`: whether `geom.gen_geom` can build the rectangular cell of the angle
+    '''
+    l = []
+    m = 2
+    while 4*(m**2 + m + 1) <= max_atoms:
+        for n in range(1, m):
+            natoms = 4*(m**2 + m*n + n**2)
+            if natoms > max_atoms or math.gcd(m, n) != 1 or (m - n) % 3 == 0:
+                continue
+            t1, t2 = get_moire_latvecs(m, n, a)
+            angle = get_angle(m, n)
+            l.append({
+                'm': m,
+                'n': n,
+                'angle': angle,
+                'natoms_hex': natoms,
+                'natoms_rect': 2*natoms if m - n == 1 else np.nan,
+                'moire_a': np.linalg.norm(t1),
+                't1_x': t1[0],
+                't1_y': t1[1],
+                't2_x': t2[0],
+                't2_y': t2[1],
+                'rect': m - n == 1,
+                'dirname': get_dirname(angle),
+                })
+        m += 1
+    d = pd.DataFrame(l).sort_values('angle', ascending=False).reset_index(drop=True)
+    return d
+
+def build_one(angle, dirname, formats=['txt', 'xsf']):
+    '''
+    Writes the rectangular starting geometry `{dirname}/twist{name}.txt` read by `in.relax`
+    '''
+    os.makedirs(dirname, exist_ok=True)
+    name = os.path.basename(os.path.normpath(dirname))
+    geom.gen_geom(angle, 'cc-cc', prefix=f'{dirname}/twist{name}', formats=formats)
+    return dirname
+
+def build(d, outdir='geom', nworkers=None, formats=['txt', 'xsf']):
+    '''
+    Builds the angles in the rows of the catalogue `d` on a process pool, into `{outdir}/{dirname}`
+    '''
+    if not d['rect'].all():
+        raise ValueError(f'geom.gen_geom only builds the n = m - 1 angles, got (m, n) = {list(zip(d.m[~d.rect], d.n[~d.rect]))}')
+    dirnames = [os.path.join(outdir, dirname) for dirname in d['dirname']]
+    if len(set(dirnames)) != len(dirnames):
+        raise ValueError('angles that round to the same directory name cannot be built together')
+    with ProcessPoolExecutor(max_workers=nworkers) as executor:
+        futures = [executor.submit(build_one, angle, dirname, formats) for angle, dirname in zip(d['angle'], dirnames)]
+        for future in futures:
+            print(f'done {future.result()}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max_atoms', default=100000, type=int)
+    parser.add_argument('--all_pairs', action='store_true', help='also list the angles that geom.py cannot build')
+    parser.add_argument('--build', nargs='*', type=float, help='build the listed angles (closest entries), or all listed angles if none are given')
+    parser.add_argument('--outdir', default='geom')
+    parser.add_argument('--nworkers', default=None, type=int)
+    parser.add_argument('--formats', nargs='+', default=['txt', 'xsf'], choices=['txt', 'xsf', 'npz'])
+    args = parser.parse_args()
+
+    d = get_catalogue(max_atoms=args.max_atoms)
+    if not args.all_pairs:
+        d = d.loc[d['rect'], :].reset_index(drop=True)
+    print(d[['m', 'n', 'angle', 'natoms_hex', 'natoms_rect', 'moire_a', 'dirname']].to_string())
+    if args.build is not None:
+        if args.build:
+            d = d.loc[[(d['angle'] - angle).abs().idxmin() for angle in args.build], :]
+        build(d, outdir=args.outdir, nworkers=args.nworkers, formats=args.formats)
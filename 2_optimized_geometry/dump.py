@@ -0,0 +1,82 @@
+'''
+Reads LAMMPS text dump files, e.g. `dump_final.txt`, into structured arrays
+
+The header of every frame is parsed once and the atom block is loaded by the C parser of `np.loadtxt`.
+The fields of the arrays are the column names of the `ITEM: ATOMS` line, e.g. `id`, `type`, `x`, `y`, `z`, `c_csym` or `c_2[1]`.
+'''
+import collections
+import itertools
+import json
+import numpy as np
+import os
+
+def read_header(f):
+    '''
+    Reads the header of the next frame from the open file `f`, returns None at the end of the file
+    `bounds`: (3, 2) array of the lower and upper box bounds, followed by the tilt factors for triclinic boxes
+    '''
+    line = f.readline()
+    if not line:
+        return None
+    if not line.startswith('ITEM: TIMESTEP'):
+        raise ValueError(f'expected ITEM: TIMESTEP, got {line!r}')
+    header = {'timestep': int(f.readline())}
+    f.readline()
+    header['natoms'] = int(f.readline())
+    header['boundary'] = f.readline().split()[3:]
+    header['bounds'] = np.array([f.readline().split() for _ in range(3)], dtype=float)
+    header['columns'] = f.readline().split()[2:]
+    return header
+
+def get_dtype(columns):
+    return np.dtype([(c, np.int64 if c in ['id', 'type', 'mol'] else np.float64) for c in columns])
+
+def read_frame(f, header, columns=None):
+    '''
+    Reads the atom block after `header` as a structured array of `columns`, all columns if None
+    '''
+    columns = header['columns'] if columns is None else columns
+    usecols = [header['columns'].index(c) for c in columns]
+    data = np.loadtxt(f, max_rows=header['natoms'], usecols=usecols, ndmin=2)
+    return np.rec.fromarrays(data.T, dtype=get_dtype(columns)).view(np.ndarray)
+
+def iter_frames(filename, columns=None):
+    '''
+    Yields (header, data) of every frame of the dump file
+    '''
+    with open(filename) as f:
+        while True:
+            header = read_header(f)
+            if header is None:
+                return
+            yield header, read_frame(f, header, columns)
+
+def read_dump(filename, columns=None, frame=-1, mmap=False):
+    '''
+    Returns (header, data) of the frame `frame` of the dump file
+    `mmap`: the frame is stored once in binary in `{filename}.npy` (and its header in `{filename}.json`),
+    which is rewritten when the dump file is newer, and returned as a read-only memory map
+    '''
+    if not mmap:
+        frames = iter_frames(filename, columns)
+        if frame < 0:
+            return collections.deque(frames, maxlen=-frame)[0]
+        return next(itertools.islice(frames, frame, None))
+
+    cache_filename = f'{filename}.npy'
+    header_filename = f'{filename}.json'
+    header = None
+    if os.path.isfile(cache_filename) and os.path.getmtime(cache_filename) >= os.path.getmtime(filename):
+        with open(header_filename) as f:
+            header = json.load(f)
+    if header is None or header['frame'] != frame:
+        header, data = read_dump(filename, frame=frame)
+        header['frame'] = frame
+        with open(header_filename, 'w') as f:
+            json.dump({**header, 'bounds': header['bounds'].tolist()}, f)
+        np.save(cache_filename, data)
+    header['bounds'] = np.array(header['bounds'])
+    data = np.load(cache_filename, mmap_mode='r')
+    if columns is not None:
+        data = data[columns]
+    return header, data
@@ -13,7 +13,7 @@ def rotation_matrix(theta_rad):
             [0, 0, 1]
         ))
 
-def get_coordinates(latvec_a, latvec_b, z):
+def get_coordinates(latvec_a, latvec_b, z, irange=(-500, 500), jrange=(-500, 500)):
     '''
     Returns the coordinate of a layer before rotation
 
@@ -21,12 +21,12 @@ def get_coordinates(latvec_a, latvec_b, z):
         latvec_a: lattice vector of a layer
         latvec_b: lattice vector of a layer (usually 60 degree from the `latvec_a`)
         z: z-coordinate of the layer
+        irange, jrange: ranges of the lattice indices along `latvec_a` and `latvec_b`
     '''
     rb0 = [0, 0]
     rb1 = rb0 + (latvec_a + latvec_b)/3
-    nhalf = 500
-    ilin = np.arange(-nhalf, nhalf)
-    jlin = np.arange(-nhalf, nhalf)
+    ilin = np.arange(*irange)
+    jlin = np.arange(*jrange)
     jv, iv = np.meshgrid(jlin, ilin, indexing='ij')
     coordinates = np.ndarray(shape=(len(jlin), len(ilin), 2, 3))
     coordinates[:, :, 0, 0] = iv*latvec_a[0] + jv*latvec_b[0] + rb0[0]
@@ -38,47 +38,56 @@ def get_coordinates(latvec_a, latvec_b, z):
     coordinates = coordinates.reshape(-1, 3)
     return coordinates
 
-def get_final_coord(phi, ss, rotlvmp, coordinates, unique_species, z):
+def get_index_bounds(latvec_a, latvec_b, phi, xmax, ymax):
+    '''
+    Returns the ranges of the lattice indices (i, j) whose sites can fall into the rectangle [0, `xmax`] x [0, `ymax`] after rotation by `-phi`
+    '''
+    corners = np.array([[0, 0], [xmax, 0], [0, ymax], [xmax, ymax]])
+    corners = corners @ rotation_matrix(phi)[:2, :2].T
+    frac = corners @ np.linalg.inv(np.array([latvec_a, latvec_b]))
+    lo = np.floor(frac.min(axis=0)).astype(int) - 1
+    hi = np.ceil(frac.max(axis=0)).astype(int) + 2
+    return (lo[0], hi[0]), (lo[1], hi[1])
+
+def get_final_coord(phi, ss, rotlvmp, latvec_a, latvec_b, unique_species, z, chunk=1000000):
     '''
     Returns supercell of rotated moire pattern for one layer
+    Only the lattice sites within the index bounds of the supercell are generated, `chunk` sites at a time,
+    so the memory is proportional to the number of atoms
 
     params:
         phi: twist angle
         ss: scaling factor
         rotlvmp: rotated lattice vector of the moire pattern
-        coordinates: unrotated coordinates from `get_coordinates` function
+        latvec_a, latvec_b: lattice vectors of the layer before rotation
         unique_species: a list of element symbols, e.g. ['C', 'C'] for twisted bilayer graphene
         z: z-coordinate of the layer
     '''
-    rotcoordinates = np.zeros(shape=coordinates.shape)
-    rotcoordinates[:, :2] = (rotation_matrix(-phi)[:2, :2] @ coordinates[:, :2].T).T
-    tot_mat = 400000
-    fincoord = np.ndarray(shape=(tot_mat, 3))
-    fincoord.fill(0)
-    v=0
-    species = []
-
-    for c in range(0, coordinates.shape[0]):
-        if (rotcoordinates[c, 0] > -0.0001 and rotcoordinates[c, 0] < ss*rotlvmp[0][0] and
-            rotcoordinates[c, 1] > -0.0001 and rotcoordinates[c, 1] < ss*rotlvmp[1][1]):
-            fincoord[v, 0] = rotcoordinates[c, 0]
-            fincoord[v, 1] = rotcoordinates[c, 1]
-            fincoord[v, 2] = z
-            if c % 2 == 0:
-                species.append(unique_species[0])
-            elif c % 2 == 1:
-                species.append(unique_species[1])
-            v += 1
+    xmax = ss*rotlvmp[0][0]
+    ymax = ss*rotlvmp[1][1]
+    irange, jrange = get_index_bounds(latvec_a, latvec_b, phi, xmax, ymax)
+    rot = rotation_matrix(-phi)[:2, :2]
+    nrows = max(1, chunk//(2*(irange[1] - irange[0])))
+
+    rotcoordinates = []
+    sites = []
+    for j in range(jrange[0], jrange[1], nrows):
+        coordinates = get_coordinates(latvec_a, latvec_b, z, irange, (j, min(j + nrows, jrange[1])))
+        rotcoordinate = (rot @ coordinates[:, :2].T).T
+        mask = ((rotcoordinate[:, 0] > -0.0001) & (rotcoordinate[:, 0] < xmax - 0.0001) &
+            (rotcoordinate[:, 1] > -0.0001) & (rotcoordinate[:, 1] < ymax - 0.0001))
+        rotcoordinates.append(rotcoordinate[mask])
+        sites.append(np.flatnonzero(mask) % 2)
+
+    rotcoordinates = np.concatenate(rotcoordinates)
+    fincoord = np.empty(shape=(len(rotcoordinates), 3))
+    fincoord[:, :2] = rotcoordinates
+    fincoord[:, 2] = z
+    species = np.array(unique_species)[np.concatenate(sites)]
     return fincoord, species
 
 def get_natoms(fincoords):
-    p = 0
-    for fincoord in fincoords:
-        for i in range(len(fincoord)-1):
-            if (fincoord[i, 0] != 0 or fincoord[i+1, 0] != 0):
-                p += 1
-    natom = int(p)
-    return natom
+    return sum(len(fincoord) for fincoord in fincoords)
 
 def get_cell_latvec(rotlvmp, cell_height, ss):
     return np.array([
@@ -112,52 +121,83 @@ def get_lammps_header(latvec, natoms, species_map):
     s += mass_section
     return s
 
-def get_atom_section(species_layers, fincoords, species_map, latvec):
-    natom = get_natoms(fincoords)
-    xyz = []
-    species_fin = []
-    atom_tag = 1
-    atom_section = 'Atoms\n\n'
+def get_atom_table(species_layers, fincoords, species_map):
+    '''
+    Returns the columns of the `Atoms` section as one array:
+    atom id, molecule id (the layer), atom type, charge, x, y, z and three image flags
+    '''
+    natoms = get_natoms(fincoords)
+    table = np.zeros(shape=(natoms, 10))
+    table[:, 0] = np.arange(1, natoms + 1)
+    start = 0
     for layer_idx, (species_layer, fincoord) in enumerate(zip(species_layers, fincoords)):
         layer_tag = layer_idx+1
-        for i in range(len(species_layer)):
-            x, y, z = fincoord[i, 0], fincoord[i, 1], fincoord[i, 2]
-            xyz.append([x, y, z])
-            species = species_layer[i]
-            species_fin.append(species)
-            species_tag = species_map[(layer_tag, species)]
-            atom_section += '%d %d %d %d %1.6f %1.6f %1.6f %d %d %d\n'%(atom_tag, layer_tag, species_tag, 0, x, y, z, 0, 0, 0)
-            atom_tag += 1
-    atoms = ase.Atoms(species_fin, cell=latvec)
-    atoms.set_positions(xyz)
-    return atom_section, atoms
-
-def write_files(prefix, rotlvmp, cell_height, ss, species_map, species_layers, fincoords):
+        end = start + len(fincoord)
+        species_layer = np.asarray(species_layer)
+        table[start:end, 1] = layer_tag
+        for species in np.unique(species_layer):
+            table[start:end, 2][species_layer == species] = species_map[(layer_tag, species)]
+        table[start:end, 4:7] = fincoord
+        start = end
+    return table
+
+def write_lammps_data(fn, header, table, chunk=100000):
+    '''
+    Streams the LAMMPS data file to `fn`, formatting `chunk` atoms at a time
+    '''
+    fmt = '%d %d %d %d %1.6f %1.6f %1.6f %d %d %d'
+    with open(fn, 'w', buffering=1 << 20) as f:
+        f.write(header)
+        f.write('Atoms\n\n')
+        for i in range(0, len(table), chunk):
+            np.savetxt(f, table[i:i+chunk], fmt=fmt)
+
+def write_xsf(fn, species_layers, table, latvec):
+    atoms = ase.Atoms(np.concatenate(species_layers), positions=table[:, 4:7], cell=latvec)
+    ase.io.write(fn, atoms, format='xsf')
+
+def write_npz(fn, header, table, latvec):
+    '''
+    Writes the data file in binary, see `npz_to_lammps_data`
+    '''
+    np.savez(fn, header=header, table=table, latvec=latvec)
+
+def npz_to_lammps_data(npz_fn, fn):
+    '''
+    Converts the binary output of `write_npz` into a LAMMPS data file, since `read_data` of LAMMPS only reads text
+    '''
+    with np.load(npz_fn) as f:
+        write_lammps_data(fn, str(f['header']), f['table'])
+
+def write_files(prefix, rotlvmp, cell_height, ss, species_map, species_layers, fincoords, formats=['txt', 'xsf']):
+    '''
+    `formats`: any of `txt` (LAMMPS data file), `xsf` and `npz` (binary copy of the LAMMPS data file)
+    '''
     natoms = get_natoms(fincoords)
     latvec = get_cell_latvec(rotlvmp, cell_height, ss)
     header = get_lammps_header(latvec, natoms, species_map)
-    atom_section, atoms = get_atom_section(species_layers, fincoords, species_map, latvec)
+    table = get_atom_table(species_layers, fincoords, species_map)
 
     print(f'writing {prefix}')
-    with open(f'{prefix}.txt', 'w') as f:
-        f.write(header)
-        f.write(atom_section)
-
-    ase.io.write(f'{prefix}.xsf', atoms, format='xsf')
-
-def gen_CCCC(phi, ss, rotlvmp, coordinates1, coordinates2, cell_height, distance, prefix='geom'):
-    fincoord1, species_1 = get_final_coord(phi, ss, rotlvmp, coordinates1, ['C', 'C'], cell_height/2 - distance/2)
-    fincoord2, species_2 = get_final_coord(phi, ss, rotlvmp, coordinates2, ['C', 'C'], cell_height/2 + distance/2)
+    if 'txt' in formats:
+        write_lammps_data(f'{prefix}.txt', header, table)
+    if 'xsf' in formats:
+        write_xsf(f'{prefix}.xsf', species_layers, table, latvec)
+    if 'npz' in formats:
+        write_npz(f'{prefix}.npz', header, table, latvec)
+
+def gen_CCCC(phi, ss, rotlvmp, lv1, lv2, cell_height, distance, prefix='geom', formats=['txt', 'xsf']):
+    fincoord1, species_1 = get_final_coord(phi, ss, rotlvmp, *lv1, ['C', 'C'], cell_height/2 - distance/2)
+    fincoord2, species_2 = get_final_coord(phi, ss, rotlvmp, *lv2, ['C', 'C'], cell_height/2 + distance/2)
     fincoords = [fincoord1, fincoord2]
     species_layers = [species_1, species_2]
-    natom = get_natoms(fincoords)
     species_map = {
         (1, 'C'): 1,
         (2, 'C'): 2
     }
-    write_files(prefix, rotlvmp, cell_height, ss, species_map, species_layers, fincoords)
+    write_files(prefix, rotlvmp, cell_height, ss, species_map, species_layers, fincoords, formats=formats)
 
-def gen_geom(twist_degree, system, a=2.46, b=2.46, cell_height=60, distance1=3.4, distance2=3.4, ss=1):
+def gen_geom(twist_degree, system, a=2.46, b=2.46, cell_height=60, distance1=3.4, distance2=3.4, ss=1, prefix='geom', formats=['txt', 'xsf']):
     theta = (np.pi/180)*twist_degree
     latvec1a = a*np.array([1/np.sqrt(2),1/np.sqrt(2)])
     latvec1b = rotation_matrix(np.pi/3)[:2,:2].dot(latvec1a)
@@ -188,14 +228,10 @@ def gen_geom(twist_degree, system, a=2.46, b=2.46, cell_height=60, distance1=3.4
     rotlvmp2 = rotation_matrix(-phi)[:2,:2].dot(lvmp[1])
     rotlvmp = [rotlvmp1, rotlvmp2]
 
-    coordinates1 = get_coordinates(latvec1a, latvec1b, 0)
-    coordinates2 = get_coordinates(latvec2a, latvec2b, 0)
-
     if system == 'cc-cc':
-        gen_CCCC(phi, ss, rotlvmp, coordinates1, coordinates2, cell_height, distance1)
+        gen_CCCC(phi, ss, rotlvmp, lv1, lv2, cell_height, distance1, prefix=prefix, formats=formats)
 
 if __name__ == '__main__':
-    # commensurate angles = 21.7867893, 13.17355112, 9.43000791, 6.0089832, 7.34099302, 5.08584781, 4.408455008, 3.89023817, 3.4...,
-    # 2.875894634, 2.0046278307, 1.4701297259, 1.1606527199, 1.08454904924, 1.0501208798, 0.98743029788, 0.5050308328, 0.1000899404333
+    # commensurate angles are listed by `python angles.py`, which also builds them in parallel
     for angle in [0.98743029788]:
         gen_geom(angle, 'cc-cc')
@@ -0,0 +1,202 @@
+'''
+Binary store of the twisted bilayer structures in `kc_{potential}/{angle}/`, e.g. `kc_qmc/0-99/`
+
+Each structure is a group `{potential}/{angle}/{relaxed|rigid}` of `geometry.hdf5` with the datasets
+`cell`, `id`, `type`, `positions`, `csym`, `stress` (6 components) and `energy` (per atom) from `dump_final.txt` or `dump_initial.txt`,
+`hex_cell` and `hex_positions` from `poscar_hex.txt` or `poscar_hex_rigid.txt`, which are the input of `3_letb`,
+and `rect_cell` and `rect_positions` from `poscar_rect.txt` or `poscar_rect_rigid.txt`.
+The inputs of the relaxation are stored next to them: the LAMMPS data file `twist*.txt` in `{potential}/{angle}/start`
+(`cell`, `id`, `mol`, `type`, `positions`), and the frames of the minimization, the dumps `min_kink1.*`
+and the AtomEye files `min_kink1_*.cfg`, in `{potential}/{angle}/min_kink/{timestep}`.
+The datasets are chunked and gzip compressed by default. With `compression=None` they are stored contiguously
+and `read_structure(..., mmap=True)` returns memory maps of the file instead of reading the arrays.
+'''
+import argparse
+import glob
+import h5py
+import numpy as np
+import os
+
+import dump
+
+store_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'geometry.hdf5')
+
+def get_key(potential, angle, relaxed=True):
+    return f'{potential}/{angle}/{"relaxed" if relaxed else "rigid"}'
+
+def read_poscar(poscar_filename):
+    '''
+    Returns the lattice vectors and cartesian positions of the POSCAR files of `rect2hex.py`
+    '''
+    latvec = np.loadtxt(poscar_filename, skiprows=2, max_rows=3)
+    positions = np.loadtxt(poscar_filename, skiprows=8, ndmin=2)
+    return latvec, positions
+
+def read_data(data_filename):
+    '''
+    Returns the cell and the atoms (`id`, `mol`, `type`, `positions`) of the LAMMPS data files `twist*.txt` of `angles.py`
+    '''
+    with open(data_filename) as f:
+        lines = f.read().split('\n')
+    natoms = int(lines[2].split()[0])
+    bounds = np.array([line.split()[:2] for line in lines[4:7]], dtype=float)
+    start = next(i for i, line in enumerate(lines) if line.startswith('Atoms')) + 2
+    atoms = np.loadtxt(lines[start:start + natoms], ndmin=2)
+    return np.diag(bounds[:, 1]), {
+        'id': atoms[:, 0].astype(np.int64),
+        'mol': atoms[:, 1].astype(np.int64),
+        'type': atoms[:, 2].astype(np.int64),
+        'positions': atoms[:, 4:7],
+        }
+
+def read_cfg(cfg_filename):
+    '''
+    Returns the cell and the cartesian positions of the extended AtomEye files `min_kink1_*.cfg` of `in.relax`
+    '''
+    with open(cfg_filename) as f:
+        lines = f.read().split('\n')
+    natoms = int(lines[0].split('=')[1])
+    cell = np.array([float(line.split('=')[1].split()[0]) for line in lines[2:11]]).reshape(3, 3)
+    # every atom is a mass, an element and a line of reduced coordinates
+    start = next(i for i, line in enumerate(lines) if line.startswith('entry_count')) + 1
+    reduced = np.loadtxt(lines[start + 2:start + 3*natoms:3], ndmin=2)
+    return cell, reduced @ cell
+
+def write_dump(g, dump_filename, compression='gzip'):
+    kwargs = dict(chunks=True, compression=compression) if compression is not None else {}
+    header, data = dump.read_dump(dump_filename)
+    g['cell'] = np.diag(header['bounds'][:, 1])
+    g.create_dataset('id', data=data['id'], **kwargs)
+    g.create_dataset('type', data=data['type'], **kwargs)
+    g.create_dataset('positions', data=np.column_stack([data['x'], data['y'], data['z']]), **kwargs)
+    g.create_dataset('csym', data=data['c_csym'], **kwargs)
+    g.create_dataset('stress', data=np.column_stack([data[f'c_2[{i}]'] for i in range(1, 7)]), **kwargs)
+    g.create_dataset('energy', data=data['c_3'], **kwargs)
+
+def write_structure(g, dirname, relaxed, compression='gzip'):
+    kwargs = dict(chunks=True, compression=compression) if compression is not None else {}
+    write_dump(g, os.path.join(dirname, 'dump_final.txt' if relaxed else 'dump_initial.txt'), compression=compression)
+    suffix = '' if relaxed else '_rigid'
+    for cut in ['hex', 'rect']:
+        poscar_filename = os.path.join(dirname, f'poscar_{cut}{suffix}.txt')
+        if os.path.isfile(poscar_filename):
+            cell, positions = read_poscar(poscar_filename)
+            g[f'{cut}_cell'] = cell
+            g.create_dataset(f'{cut}_positions', data=positions, **kwargs)
+
+def write_inputs(f, potential, angle, dirname, compression='gzip', overwrite=False):
+    '''
+    Adds the starting data file and the minimization frames of `dirname` to the open store `f`
+    '''
+    kwargs = dict(chunks=True, compression=compression) if compression is not None else {}
+    groups = {}
+    for data_filename in glob.glob(os.path.join(dirname, 'twist*.txt')):
+        groups[f'{potential}/{angle}/start'] = ('data', data_filename)
+    # a dump replaces the AtomEye file of the same timestep, as it has more fields
+    for cfg_filename in glob.glob(os.path.join(dirname, 'min_kink1_*.cfg')):
+        groups[f'{potential}/{angle}/min_kink/{os.path.basename(cfg_filename)[len("min_kink1_"):-len(".cfg")]}'] = ('cfg', cfg_filename)
+    for dump_filename in glob.glob(os.path.join(dirname, 'min_kink1.*')):
+        groups[f'{potential}/{angle}/min_kink/{os.path.basename(dump_filename).split(".", 1)[1]}'] = ('dump', dump_filename)
+
+    for key, (kind, filename) in sorted(groups.items()):
+        if key in f:
+            if not overwrite:
+                continue
+            del f[key]
+        print(f'writing {key}')
+        g = f.create_group(key)
+        if kind == 'data':
+            cell, atoms = read_data(filename)
+            g['cell'] = cell
+            for field, value in atoms.items():
+                g.create_dataset(field, data=value, **kwargs)
+        elif kind == 'dump':
+            write_dump(g, filename, compression=compression)
+        else:
+            cell, positions = read_cfg(filename)
+            g['cell'] = cell
+            g.create_dataset('positions', data=positions, **kwargs)
+
+def convert(potentials=['qmc', 'ouyang', 'dft_d2', 'dft_d3'], filename=store_filename, compression='gzip', overwrite=False):
+    '''
+    Adds the structures of all `kc_{potential}/{angle}` directories to the store, skipping those already stored unless `overwrite`
+    '''
+    workdir = os.path.dirname(os.path.abspath(__file__))
+    with h5py.File(filename, 'a') as f:
+        for potential in potentials:
+            for dirname in sorted(glob.glob(os.path.join(workdir, f'kc_{potential}', '*'))):
+                angle = os.path.basename(dirname)
+                for relaxed in [True, False]:
+                    if not os.path.isfile(os.path.join(dirname, 'dump_final.txt' if relaxed else 'dump_initial.txt')):
+                        continue
+                    key = get_key(potential, angle, relaxed)
+                    if key in f:
+                        if not overwrite:
+                            continue
+                        del f[key]
+                    print(f'writing {key}')
+                    write_structure(f.create_group(key), dirname, relaxed, compression=compression)
+                write_inputs(f, potential, angle, dirname, compression=compression, overwrite=overwrite)
+
+def has_structure(potential, angle, relaxed=True, filename=store_filename):
+    if not os.path.isfile(filename):
+        return False
+    with h5py.File(filename, 'r') as f:
+        return get_key(potential, angle, relaxed) in f
+
+def get_memmap(dset):
+    '''
+    Returns a read-only memory map of a contiguous dataset
+    '''
+    offset = dset.id.get_offset()
+    if offset is None:
+        raise ValueError(f'{dset.name} is chunked or compressed and cannot be memory mapped')
+    return np.memmap(dset.file.filename, mode='r', dtype=dset.dtype, shape=dset.shape, offset=offset)
+
+def read_group(key, fields=None, mmap=False, filename=store_filename):
+    '''
+    Returns a dictionary of the datasets in `fields` (all if None) of the group `key`
+    `mmap`: memory maps the contiguous datasets, the others are read
+    '''
+    with h5py.File(filename, 'r') as f:
+        g = f[key]
+        fields = list(g.keys()) if fields is None else fields
+        structure = {}
+        for field in fields:
+            dset = g[field]
+            structure[field] = get_memmap(dset) if mmap and dset.chunks is None else dset[()]
+    return structure
+
+def read_structure(potential, angle, relaxed=True, fields=None, mmap=False, filename=store_filename):
+    '''
+    Returns a dictionary of the datasets in `fields` (all if None) of one structure, see `read_group`
+    '''
+    return read_group(get_key(potential, angle, relaxed), fields=fields, mmap=mmap, filename=filename)
+
+def read_start(potential, angle, fields=None, mmap=False, filename=store_filename):
+    '''
+    Returns the datasets of the starting data file `twist*.txt` of a structure, see `read_group`
+    '''
+    return read_group(f'{potential}/{angle}/start', fields=fields, mmap=mmap, filename=filename)
+
+def get_min_kink_steps(potential, angle, filename=store_filename):
+    '''
+    Returns the sorted timesteps of the stored minimization frames of a structure
+    '''
+    with h5py.File(filename, 'r') as f:
+        key = f'{potential}/{angle}/min_kink'
+        return sorted(int(step) for step in f[key]) if key in f else []
+
+def read_min_kink(potential, angle, step, fields=None, mmap=False, filename=store_filename):
+    '''
+    Returns the datasets of the minimization frame at `step` of a structure, see `read_group`
+    '''
+    return read_group(f'{potential}/{angle}/min_kink/{step}', fields=fields, mmap=mmap, filename=filename)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--potentials', nargs='+', default=['qmc', 'ouyang', 'dft_d2', 'dft_d3'])
+    parser.add_argument('--no_compression', action='store_true')
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+    convert(potentials=args.potentials, compression=None if args.no_compression else 'gzip', overwrite=args.overwrite)
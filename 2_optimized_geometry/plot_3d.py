@@ -3,6 +3,7 @@ Plot the coorugation in 3D
 
 Author: Kittithat Krongchon
 '''
+import argparse
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 from matplotlib.colors import LightSource
@@ -11,9 +12,12 @@ from matplotlib import colors
 from matplotlib import cm
 import pandas as pd
 import numpy as np
+import os
 import scipy.interpolate
 import seaborn as sns
-import re
+
+import dump
+import geom_store
 
 plt.rc('font', family='serif')
 plt.rc('text', usetex=True)
@@ -31,34 +35,41 @@ def dumpfile_to_df(dumpfile):
     '''
     Reads lammps dump file to data frame
     '''
-    with open(dumpfile) as f:
-        text = f.read()
-    m = re.search('ITEM: BOX BOUNDS pp pp pp\n0.0000000000000000e\+00\s+(\S+)\n0.0000000000000000e\+00\s+(\S+)\s+0.0000000000000000e\+00\s+(\S+)', text)
-    latvec = [
-        [float(m.group(1)), 0.0, 0.0],
-        [0.0, float(m.group(2)), 0.0],
-        [0.0, 0.0, float(m.group(3))]
-        ]
+    header, data = dump.read_dump(dumpfile)
+    latvec = np.diag(header['bounds'][:, 1]).tolist()
 
-    lines = [l.split() for l in text.split('\n')[9:] if l]
-    df = pd.DataFrame(lines).astype(np.float64)
+    df = pd.DataFrame(data)
     df.columns = ['atom_id', 'atom_type', 'x', 'y', 'z', 'c_csym', 'stress_1', 'stress_2', 'stress_3', 'stress_4', 'stress_5', 'stress_6', 'energy']
-    df['atom_id'] = df['atom_id'].astype(int)
-    df['atom_type'] = df['atom_type'].astype(int)
     df = df.sort_values(by='atom_id').reset_index(0, drop=True)
 
     return df, latvec
 
-def get_data(twist_angle, potential, relaxed=True, atom_type=1, rotate=False):
+def store_to_df(twist_angle, potential, relaxed=True):
     '''
-    Creates a data frame from `twist_angle` and `potential`.
-    `atom_type` (int):
-        1 for the bottom layer
-        2 for the top layer
+    Reads the same data frame as `dumpfile_to_df` from `geom_store`
+    '''
+    s = geom_store.read_structure(potential, twist_angle, relaxed, fields=['cell', 'id', 'type', 'positions', 'csym', 'stress', 'energy'], mmap=True)
+    df = pd.DataFrame({'atom_id': s['id'], 'atom_type': s['type']})
+    df[['x', 'y', 'z']] = s['positions']
+    df['c_csym'] = s['csym']
+    df[[f'stress_{i}' for i in range(1, 7)]] = s['stress']
+    df['energy'] = s['energy']
+    df = df.sort_values(by='atom_id').reset_index(0, drop=True)
+    return df, s['cell'].tolist()
+
+def read_all(twist_angle, potential, relaxed=True):
+    '''
+    Reads both layers from `geom_store` if the structure is stored there, otherwise from the dump file
     '''
+    if geom_store.has_structure(potential, twist_angle, relaxed):
+        return store_to_df(twist_angle, potential, relaxed)
     which_dump = 'final' if relaxed else 'initial'
-    d_all, latvec = dumpfile_to_df(f"kc_{potential}/{twist_angle}/dump_{which_dump}.txt")
+    return dumpfile_to_df(f"kc_{potential}/{twist_angle}/dump_{which_dump}.txt")
 
+def get_layer(d_all, latvec, twist_angle, potential, atom_type=1, rotate=False):
+    '''
+    Selects one layer of `d_all` and tiles it, see `get_data`
+    '''
     # select only one layer
     d = d_all.loc[d_all.atom_type == atom_type, :].reset_index(0, drop=True)
 
@@ -87,6 +98,59 @@ def get_data(twist_angle, potential, relaxed=True, atom_type=1, rotate=False):
     d = pd.concat([tile1, tile2, tile3, d_rotated], ignore_index=True)
     return d
 
+def get_data(twist_angle, potential, relaxed=True, atom_type=1, rotate=False):
+    '''
+    Creates a data frame from `twist_angle` and `potential`.
+    `atom_type` (int):
+        1 for the bottom layer
+        2 for the top layer
+    '''
+    d_all, latvec = read_all(twist_angle, potential, relaxed)
+    return get_layer(d_all, latvec, twist_angle, potential, atom_type=atom_type, rotate=rotate)
+
+def get_source_signature(twist_angle, potential, relaxed=True):
+    '''
+    Source of `read_all` (1 for `geom_store`, 0 for the dump file) and the modification time and size of its file,
+    which invalidate the cache of `get_corrugation`
+    '''
+    if geom_store.has_structure(potential, twist_angle, relaxed):
+        st = os.stat(geom_store.store_filename)
+        return np.array([1, st.st_mtime_ns, st.st_size])
+    which_dump = 'final' if relaxed else 'initial'
+    st = os.stat(f"kc_{potential}/{twist_angle}/dump_{which_dump}.txt")
+    return np.array([0, st.st_mtime_ns, st.st_size])
+
+def get_corrugation(twist_angle, potential, relaxed=True, cache_dir='processed/corrugation'):
+    '''
+    Returns the tiled bottom and top layers (`x`, `y`, `z`) with `z` centered as in `plot_tbg`.
+    The result is computed once and stored in `{cache_dir}/{twist_angle}_{potential}_{relaxed|rigid}.npz`,
+    which is recomputed when the dump file or the geometry store changes
+    '''
+    cache_filename = f'{cache_dir}/{twist_angle}_{potential}_{"relaxed" if relaxed else "rigid"}.npz'
+    signature = get_source_signature(twist_angle, potential, relaxed)
+    cache = {}
+    if os.path.isfile(cache_filename):
+        with np.load(cache_filename) as f:
+            if np.array_equal(f['signature'], signature):
+                cache = dict(f)
+
+    if not cache:
+        d_all, latvec = read_all(twist_angle, potential, relaxed)
+        b = get_layer(d_all, latvec, twist_angle, potential, atom_type=1)
+        t = get_layer(d_all, latvec, twist_angle, potential, atom_type=2)
+        center = (b.z.mean() + t.z.mean())/2
+        mid_t = (t.z.max() + t.z.min())/2 - center
+        cache['signature'] = signature
+        for layer, d in [('b', b), ('t', t)]:
+            cache[f'{layer}_x'] = d.x.values
+            cache[f'{layer}_y'] = d.y.values
+            cache[f'{layer}_z'] = d.z.values - center - mid_t
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(cache_filename, **cache)
+
+    b, t = [pd.DataFrame({'x': cache[f'{layer}_x'], 'y': cache[f'{layer}_y'], 'z': cache[f'{layer}_z']}) for layer in ['b', 't']]
+    return b, t
+
 def get_label(pot):
     label_map = {
         'qmc': 'KC-QMC',
@@ -117,10 +181,18 @@ def _set_axes_radius(ax, origin, radius):
     ax.set_ylim3d([y - radius, y + radius])
     # ax.set_zlim3d([z - radius, z + radius])
 
-def get_spline(d, n=200, fix_z=False):
-    x = d.x
-    y = d.y
-    z = d.z
+def get_spline(d, n=200, fix_z=False, method='rbf', neighbors=64, max_points=None, seed=0):
+    '''
+    Interpolates the surface z(x, y) of the atoms in `d` on a `n` by `n` grid
+    `method`:
+        `rbf`: thin plate spline RBF fitted to the `neighbors` nearest atoms of each grid point, all atoms if `neighbors` is None
+        `clough_tocher`: piecewise cubic interpolation on the Delaunay triangulation of the atoms
+    `max_points`: interpolates a random subset of at most `max_points` atoms drawn with `seed`
+    The memory of both methods is linear in the number of atoms unless `neighbors` is None
+    '''
+    x = d.x.values
+    y = d.y.values
+    z = d.z.values
 
     x_grid = np.linspace(x.min(), x.max(), n)
     y_grid = np.linspace(y.min(), y.max(), n)
@@ -128,17 +200,34 @@ def get_spline(d, n=200, fix_z=False):
 
     if fix_z:
         Z = np.ones((n, n))*z[0]
+        return X, Y, Z
+
+    if max_points is not None and len(x) > max_points:
+        idx = np.random.default_rng(seed).choice(len(x), max_points, replace=False)
+        x, y, z = x[idx], y[idx], z[idx]
+    points = np.column_stack([x, y])
+    grid = np.column_stack([X.ravel(), Y.ravel()])
+    if method == 'rbf':
+        spline = scipy.interpolate.RBFInterpolator(points, z, neighbors=neighbors, kernel='thin_plate_spline', smoothing=5)
+    elif method == 'clough_tocher':
+        spline = scipy.interpolate.CloughTocher2DInterpolator(points, z, fill_value=np.mean(z))
     else:
-        spline = scipy.interpolate.Rbf(x, y, z, function='thin_plate', smooth=5, episilon=5)
-        Z = spline(X, Y)
+        raise ValueError(f'unknown method {method}')
+    Z = spline(grid).reshape(n, n)
 
     return X, Y, Z
 
-def plot_surface(ax, d, alpha=1, fix_z=False):
-    X, Y, Z = get_spline(d, fix_z=fix_z)
+def plot_surface(ax, d, alpha=1, fix_z=False, vmin=None, vmax=None, method='rbf', neighbors=64, max_points=None):
+    '''
+    Plots the surface of `get_spline`, flat in one color if `fix_z`, otherwise shaded and colored by z between `vmin` and `vmax`
+    '''
+    X, Y, Z = get_spline(d, fix_z=fix_z, method=method, neighbors=neighbors, max_points=max_points)
     ls = LightSource(270, 45)
-    rgb = ls.shade(Z, cmap=cm.coolwarm, vert_exag=0.1, blend_mode='soft')
-    ax.plot_surface(X, Y, Z, color=cm.coolwarm(0))
+    if fix_z:
+        ax.plot_surface(X, Y, Z, color=cm.coolwarm(0))
+        return
+    rgb = ls.shade(Z, cmap=cm.coolwarm, vert_exag=0.1, blend_mode='soft', vmin=vmin, vmax=vmax)
+    ax.plot_surface(X, Y, Z, facecolors=rgb, alpha=alpha, linewidth=0, antialiased=False)
 
 
 def get_divnorm(d, vcenter=None):
@@ -172,23 +261,24 @@ def rescale(v, vmin, vmax):
     # return (v - v.min())/(v.max() - v.min())*(vmax - vmin) + vmin
     return  (v - v.min())/(vmax - vmin)*(v.max() - v.min()) + v.min()
 
-def plot_tbg(ax, twist_angle, pot, label, relax=True, label_on=False, vmin=None, vmax=None):
-    b = get_data(twist_angle, pot, relaxed=relax, atom_type=1)
-    t = get_data(twist_angle, pot, relaxed=relax, atom_type=2)
-    center = (b.z.mean() + t.z.mean())/2
-    b.z -= center
-    t.z -= center
-    mid_t = (t.z.max() + t.z.min())/2
-    b.z -= mid_t
-    t.z -= mid_t
+def plot_tbg(ax, twist_angle, pot, label, relax=True, label_on=False, vmin=None, vmax=None, surface=False, spline_kwargs={}):
+    '''
+    Plots both layers, as scattered atoms or, if `surface`, as the surfaces of `get_spline` with the options `spline_kwargs`
+    '''
+    b, t = get_corrugation(twist_angle, pot, relaxed=relax)
     mid_b = (b.z.max() + b.z.min())/2
 
     if relax:
         print(pot)
         print(t.z.max())
         print(t.z.min())
-        ax.scatter(b.x, b.y, b.z, marker='o', s=0.5, c=b.z, cmap='coolwarm', zorder=10, vmin=vmin + mid_b, vmax=vmax + mid_b)
-        p = ax.scatter(t.x, t.y, t.z, marker='o', s=0.5, c=t.z, cmap='coolwarm', zorder=20, vmin=vmin, vmax=vmax)
+        if surface:
+            plot_surface(ax, b, vmin=vmin + mid_b, vmax=vmax + mid_b, **spline_kwargs)
+            plot_surface(ax, t, vmin=vmin, vmax=vmax, **spline_kwargs)
+            p = cm.ScalarMappable(norm=colors.Normalize(vmin=vmin, vmax=vmax), cmap='coolwarm')
+        else:
+            ax.scatter(b.x, b.y, b.z, marker='o', s=0.5, c=b.z, cmap='coolwarm', zorder=10, vmin=vmin + mid_b, vmax=vmax + mid_b)
+            p = ax.scatter(t.x, t.y, t.z, marker='o', s=0.5, c=t.z, cmap='coolwarm', zorder=20, vmin=vmin, vmax=vmax)
 
         if label_on:
             label_stackings(ax, t)
@@ -228,7 +318,7 @@ def get_clean_ticks(vmin, vmax, freq):
     ticks = np.arange(tick_min, tick_max+freq, freq)
     return ticks
 
-def plot_tbg_wrapper(twist_angle, pots, ext='png', vmin=-0.06, vmax=0.06, with_cbar=True):
+def plot_tbg_wrapper(twist_angle, pots, ext='png', vmin=-0.06, vmax=0.06, with_cbar=True, surface=False, spline_kwargs={}):
     ncols = len(pots)
     fig, axs = plt.subplots(ncols=ncols, subplot_kw=dict(projection='3d'), figsize=(7, 3))
 
@@ -240,7 +330,7 @@ def plot_tbg_wrapper(twist_angle, pots, ext='png', vmin=-0.06, vmax=0.06, with_c
         letter = chr(ord('a') + i)
         label = f'({letter}) {get_label(pot)}'
         label_on = True if pot == 'qmc' else False
-        p = plot_tbg(ax, twist_angle, pot, label, relax=True, vmin=vmin, vmax=vmax, label_on=label_on)
+        p = plot_tbg(ax, twist_angle, pot, label, relax=True, vmin=vmin, vmax=vmax, label_on=label_on, surface=surface, spline_kwargs=spline_kwargs)
 
     if with_cbar:
         cbar = ax.figure.colorbar(p, cax=create_colorbar(fig, ax, '$\\delta z~(\\mathrm{\\AA})$'))
@@ -248,8 +338,18 @@ def plot_tbg_wrapper(twist_angle, pots, ext='png', vmin=-0.06, vmax=0.06, with_c
 
     fig.tight_layout()
     cbar_label = '_cbar' if with_cbar else ''
-    plt.savefig(f'{twist_angle}_3d{cbar_label}.{ext}', dpi=600, bbox_inches='tight', transparent=True)
+    surface_label = '_surface' if surface else ''
+    plt.savefig(f'{twist_angle}_3d{surface_label}{cbar_label}.{ext}', dpi=600, bbox_inches='tight', transparent=True)
 
 if __name__ == '__main__':
-    twist_angle = '0-99'
-    plot_tbg_wrapper(twist_angle, ['qmc', 'ouyang', 'dft_d2', 'dft_d3'])
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--twist_angle', default='0-99')
+    parser.add_argument('--pots', nargs='+', default=['qmc', 'ouyang', 'dft_d2', 'dft_d3'])
+    parser.add_argument('--ext', default='png')
+    parser.add_argument('--surface', action='store_true', help='plot the interpolated surfaces of the layers instead of the atoms')
+    parser.add_argument('--method', default='rbf', choices=['rbf', 'clough_tocher'], help='interpolation of the surfaces')
+    parser.add_argument('--neighbors', default=64, type=int, help='nearest atoms of every grid point in the rbf fit, all atoms if 0')
+    parser.add_argument('--max_points', default=None, type=int, help='random subset of atoms interpolated, all atoms if not given')
+    args = parser.parse_args()
+    spline_kwargs = dict(method=args.method, neighbors=args.neighbors if args.neighbors > 0 else None, max_points=args.max_points)
+    plot_tbg_wrapper(args.twist_angle, args.pots, ext=args.ext, surface=args.surface, spline_kwargs=spline_kwargs)
@@ -3,8 +3,14 @@ Convert rectangular cells to hexagonal cells for local-environment tight-binding
 
 Author: Tawfiqur Rakib (trakib2)
 """
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import os
 
-import numpy as np 
+import angles
+import dump
+import geom_store
 
 def POSCAR_writer(filename, atom_num, a1, a2, b2, c3, xyz):
     '''
@@ -24,21 +30,16 @@ def POSCAR_writer(filename, atom_num, a1, a2, b2, c3, xyz):
     -------
     file
     '''
-    f = open(filename, "w")
-    f.write('written by TR \n')
-    f.write('%.9f \n'%(1.0))
-    f.write('%.9f %.9f %.9f \n'%(a1, 0.0, 0.0))
-    f.write('%.9f %.9f %.9f \n'%(a2,b2, 0.0))
-    f.write('%.9f %.9f %.9f \n'%(0.0, 0.0, c3))
-    f.write('Type1 \n')
-    f.write('%d\n'%(atom_num))
-    f.write('Cartesian \n')
-
-    for i in range (atom_num):
-        f.write('%1.8f %1.8f %1.8f \n'%(xyz[i,0],xyz[i,1],xyz[i,2]))
-
-    
-    f.close()
+    with open(filename, "w", buffering=1 << 20) as f:
+        f.write('written by TR \n')
+        f.write('%.9f \n'%(1.0))
+        f.write('%.9f %.9f %.9f \n'%(a1, 0.0, 0.0))
+        f.write('%.9f %.9f %.9f \n'%(a2,b2, 0.0))
+        f.write('%.9f %.9f %.9f \n'%(0.0, 0.0, c3))
+        f.write('Type1 \n')
+        f.write('%d\n'%(atom_num))
+        f.write('Cartesian \n')
+        np.savetxt(f, xyz[:atom_num], fmt='%1.8f %1.8f %1.8f ')
 
 def lammps_data_reader(filename):
     '''
@@ -94,21 +95,11 @@ def periodic_extension(atom_num, lenx, leny, lenz, px, py, xyz):
     periodic_lenx = lenx*px
     periodic_leny = leny*py
     periodic_lenz = lenz
-    periodic_xyz = np.zeros((atom_num*px*py,3))
-    periodic_xyz[0:atom_num,0] = xyz[0:atom_num,0] 
-    periodic_xyz[0:atom_num,1] = xyz[0:atom_num,1] 
-    periodic_xyz[0:atom_num,2] = xyz[0:atom_num,2] 
-    if px>1:
-        for i in range (1,px):
-            periodic_xyz[i*atom_num:(i+1)*atom_num,0] = periodic_xyz[(i-1)*atom_num:i*atom_num,0] + lenx
-            periodic_xyz[i*atom_num:(i+1)*atom_num,1] = periodic_xyz[(i-1)*atom_num:i*atom_num,1] 
-            periodic_xyz[i*atom_num:(i+1)*atom_num,2] = periodic_xyz[(i-1)*atom_num:i*atom_num,2] 
-            
-    if py>1:
-        for i in range (1,py):
-            periodic_xyz[i*atom_num*px:(i+1)*atom_num*px,0] = periodic_xyz[(i-1)*atom_num*px:i*atom_num*px,0] 
-            periodic_xyz[i*atom_num*px:(i+1)*atom_num*px,1] = periodic_xyz[(i-1)*atom_num*px:i*atom_num*px,1] + leny
-            periodic_xyz[i*atom_num*px:(i+1)*atom_num*px,2] = periodic_xyz[(i-1)*atom_num*px:i*atom_num*px,2]
+    # the copies are ordered along x first, then along y
+    shifts = np.zeros((py, px, 1, 3))
+    shifts[:, :, 0, 0] = np.arange(px)[None, :]*lenx
+    shifts[:, :, 0, 1] = np.arange(py)[:, None]*leny
+    periodic_xyz = (xyz[None, None, :atom_num] + shifts).reshape(-1, 3)
     periodic_atom_num = atom_num*px*py
     return periodic_atom_num, periodic_lenx, periodic_leny, periodic_lenz, periodic_xyz
 
@@ -139,17 +130,14 @@ def recttohex_cutter(atom_num, periodic_atom_num, periodic_lenx, periodic_leny,
     a2 = a1/2
     b2 = (periodic_lenx*np.cos(angle/2))/2
     c3 = periodic_lenz
-    hex_xyz = np.zeros((int(atom_num/2),3))
     hex_atom_num = int(atom_num/2)
-    p = 0
-    for i in range (periodic_atom_num):
-        if (periodic_xyz[i,1]<periodic_leny/2-tol):
-            if (periodic_xyz[i,0]>periodic_xyz[i,1]/np.tan(angle)-tol) and \
-                (periodic_xyz[i,0]<periodic_lenx/2 + periodic_xyz[i,1]/np.tan(angle)-tol):
-                    hex_xyz[p,0] = periodic_xyz[i,0]
-                    hex_xyz[p,1] = periodic_xyz[i,1]
-                    hex_xyz[p,2] = periodic_xyz[i,2]
-                    p = p+1
+    x = periodic_xyz[:periodic_atom_num, 0]
+    y = periodic_xyz[:periodic_atom_num, 1]
+    shear = y/np.tan(angle)
+    mask = (y < periodic_leny/2 - tol) & (x > shear - tol) & (x < periodic_lenx/2 + shear - tol)
+    if mask.sum() != hex_atom_num:
+        raise ValueError(f'the hexagonal cell has {mask.sum()} atoms instead of {hex_atom_num}')
+    hex_xyz = periodic_xyz[:periodic_atom_num][mask]
     return hex_atom_num, a1, a2, b2, c3, hex_xyz
 
 def dump_reader(filename):
@@ -163,41 +151,60 @@ def dump_reader(filename):
     xyz : coordinates
 
     '''
-    f=open(filename, "r")
-    lines=f.readlines()
-    atom_num = int(lines[3].split('\t')[0])
-    lenx = float(lines[5].split(' ')[1])
-    leny = float(lines[6].split(' ')[1])
-    lenz = float(lines[7].split(' ')[1])
-    
-    xyz = np.zeros((atom_num,3))
-    for i in range (atom_num):
-        xyz[i,0] = float(lines[i+9].split(' ')[2])
-        xyz[i,1] = float(lines[i+9].split(' ')[3])
-        xyz[i,2] = float(lines[i+9].split(' ')[4])
-    f.close()
+    header, data = dump.read_dump(filename, columns=['x', 'y', 'z'])
+    atom_num = header['natoms']
+    lenx, leny, lenz = header['bounds'][:, 1]
+    xyz = np.column_stack([data['x'], data['y'], data['z']])
     return atom_num, lenx, leny, lenz, xyz
 
+def store_reader(potential, angle, relaxed=True):
+    '''
+    Same as `dump_reader` for a structure of `geom_store`
+    '''
+    structure = geom_store.read_structure(potential, angle, relaxed, fields=['cell', 'positions'], mmap=True)
+    xyz = structure['positions']
+    lenx, leny, lenz = np.diag(structure['cell'])
+    return len(xyz), lenx, leny, lenz, xyz
+
+def convert(dirname, rigid=False, px=2, py=1, tol=0.005):
+    '''
+    Writes `poscar_rect.txt` and `poscar_hex.txt` of the relaxed structure in `dirname`,
+    or `poscar_rect_rigid.txt` and `poscar_hex_rigid.txt` of the starting structure if `rigid`
+    The structure is read from `geom_store` if it is stored there
+    '''
+    dump_filename = 'dump_initial.txt' if rigid else 'dump_final.txt'
+    suffix = '_rigid' if rigid else ''
+    potential = os.path.basename(os.path.dirname(os.path.normpath(dirname))).replace('kc_', '', 1)
+    angle = os.path.basename(os.path.normpath(dirname))
+    if geom_store.has_structure(potential, angle, not rigid):
+        atom_num, lenx, leny, lenz, xyz = store_reader(potential, angle, not rigid)
+    else:
+        atom_num, lenx, leny, lenz, xyz = dump_reader(os.path.join(dirname, dump_filename))
+    POSCAR_writer(os.path.join(dirname, f'poscar_rect{suffix}.txt'), atom_num, lenx, 0.0, leny, lenz, xyz)
+    periodic_atom_num, periodic_lenx, periodic_leny, periodic_lenz, periodic_xyz = periodic_extension(atom_num, lenx, leny, lenz, px, py, xyz)
+    hex_atom_num, a1, a2, b2, c3, hex_xyz = recttohex_cutter(atom_num, periodic_atom_num, periodic_lenx, periodic_leny, periodic_lenz, periodic_xyz, tol)
+    POSCAR_writer(os.path.join(dirname, f'poscar_hex{suffix}.txt'), hex_atom_num, a1, a2, b2, c3, hex_xyz)
+    return dirname
+
+def convert_all(potentials, thetas, rigid=False, nworkers=None):
+    '''
+    Converts the `{potential}/{angle}` directories of all `potentials` and `thetas` concurrently
+    '''
+    dirnames = [os.path.join(potential, angles.get_dirname(theta)) for potential in potentials for theta in thetas]
+    with ProcessPoolExecutor(max_workers=nworkers) as executor:
+        futures = {executor.submit(convert, dirname, rigid): dirname for dirname in dirnames}
+        for future in as_completed(futures):
+            try:
+                print(f'done {future.result()}')
+            except (OSError, ValueError) as e:
+                print(f'failed {futures[future]}: {e}')
+
 if __name__=="__main__":
-    theta = [0.84, 0.93, 0.99, 1.05, 1.08, 1.16, 1.20, 1.25, 1.29, 1.35, 1.41, 1.47, 1.54, 1.61, 1.70, 1.79, 1.89, 2.00, 2.88, 3.89, 4.40]
-    for i in range (len(theta)):
-        theta1 = str(theta[i])
-        st = theta1.split('.')
-        folder = st[0]+'-'+st[1]
-        filename = folder+"/"+"dump_final.txt";
-        
-        atom_num, lenx, leny, lenz, xyz = dump_reader(filename)
-        xyz1= xyz
-        filename1 = "POSCAR_"+folder+".txt";
-        filename2 = "POSCAR_"+folder+"_hex.txt";
-        a1 = lenx
-        a2 = 0.0
-        b2 = leny
-        c3 = lenz
-        POSCAR_writer(filename1, atom_num, a1, a2, b2, c3, xyz)
-        px = 2
-        py = 1
-        periodic_atom_num, periodic_lenx, periodic_leny, periodic_lenz, periodic_xyz = periodic_extension(atom_num, lenx, leny, lenz, px, py, xyz)
-        tol = 0.005
-        hex_atom_num, a1, a2, b2, c3, hex_xyz = recttohex_cutter(atom_num, periodic_atom_num, periodic_lenx, periodic_leny, periodic_lenz, periodic_xyz, tol)
-        POSCAR_writer(filename2, hex_atom_num, a1, a2, b2, c3, hex_xyz)       
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--potentials', nargs='+', default=['kc_qmc', 'kc_ouyang', 'kc_dft_d2', 'kc_dft_d3'])
+    parser.add_argument('--thetas', nargs='+', type=float,
+        default=[0.84, 0.93, 0.99, 1.05, 1.08, 1.16, 1.20, 1.25, 1.29, 1.35, 1.41, 1.47, 1.54, 1.61, 1.70, 1.79, 1.89, 2.00, 2.88, 3.89, 4.40])
+    parser.add_argument('--rigid', action='store_true')
+    parser.add_argument('--nworkers', default=None, type=int)
+    args = parser.parse_args()
+    convert_all(args.potentials, args.thetas, rigid=args.rigid, nworkers=args.nworkers)
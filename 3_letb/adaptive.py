@@ -0,0 +1,217 @@
+'''
+Adaptive sampling of the k path K - Gamma - M - K' for the bandwidth and gaps of the flat bands
+
+Every segment of the path starts from a coarse uniform grid and is refined by bisection
+in every interval where the interpolation error of the tracked bands estimated from the curvature, |E''| dk^2/8, is above `tol`.
+The refinement stops when no interval is flagged, so the bands and thus the gaps are converged to about `tol`,
+or when `max_iter` iterations are used up, which is recorded as `budget_exhausted` in `refinement.json`.
+The tracked bands are the four flat bands and the bands below and above them, counted from charge neutrality,
+so the gaps do not depend on the energy thresholds of `plot_twist_angle.get_ylim`.
+
+The result is written in the format of `solve.py` to `bands/{twist_angle}_{pot}_{relax_keyword}_adaptive/`,
+and the refinement statistics of every segment to `refinement.json` in the same directory.
+'''
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import h5py
+import json
+import numpy as np
+import os
+
+import hamiltonian
+import solve
+
+nodes = solve.k_nodes
+node_labels = ['K', 'Gamma', 'M', "K'"]
+
+def get_tracked_rows(nrows):
+    '''
+    Returns the rows of the hole band, the four flat bands and the electron band,
+    where row `nrows//2` is the lowest band above charge neutrality as in `hamiltonian.solve_sparse`
+    '''
+    center = nrows//2
+    return {'hole': [center - 3], 'flat': list(range(center - 2, center + 2)), 'elec': [center + 2]}
+
+def get_gaps(evals):
+    '''
+    Returns the gaps in meV of the bands `evals` (nrows, nk) in eV, named as in `plot_twist_angle.get_gaps`
+    '''
+    rows = get_tracked_rows(evals.shape[0])
+    hole = evals[rows['hole']]*1000
+    flat = evals[rows['flat']]*1000
+    elec = evals[rows['elec']]*1000
+    return {
+        'elec_gap': np.nanmin(elec) - np.nanmax(flat),
+        'flat_gap': np.nanmax(flat) - np.nanmin(flat),
+        'hole_gap': np.nanmin(flat) - np.nanmax(hole),
+        }
+
+def get_k_metric(letb):
+    '''
+    Metric of the reduced k coordinates, as in `pythtb.tb_model.k_path`
+    '''
+    lat_per = letb._lat[letb._per]
+    return np.linalg.inv(lat_per @ lat_per.T)
+
+def flag_intervals(x, e, tol, min_dx):
+    '''
+    Returns a mask of the intervals between the sorted points `x` of one segment to bisect, and their estimated error
+    `e`: (nbands, n) energies of the tracked bands at `x`
+    '''
+    h = np.diff(x)
+    err = np.zeros(len(h))
+    if len(x) >= 3:
+        slope = np.diff(e, axis=1)/h
+        curv = 2*np.diff(slope, axis=1)/(h[:-1] + h[1:])
+        # curvature at the ends of every interval, the nodes have none
+        c = np.abs(curv)
+        c_left = np.pad(c, ((0, 0), (1, 0)))
+        c_right = np.pad(c, ((0, 0), (0, 1)))
+        err = np.max(np.maximum(c_left, c_right), axis=0)*h**2/8
+    return (err > tol) & (h > min_dx), err
+
+def refine(solve_points, k_metric, nk0=16, tol=0.1, min_dk=1e-5, max_iter=20, max_nk=None):
+    '''
+    Samples the k path adaptively, `solve_points` returns the bands (nrows, n) at the reduced k points (n, 2)
+    `nk0`: number of starting points of the path, distributed over the segments by length
+    `tol`: interpolation error in meV of the tracked bands
+    `min_dk`: smallest interval in the distance units of `k_dist`
+    `max_iter`, `max_nk`: budget of refinement iterations and of k points on the path, no limit on the k points if None
+    Returns the k points, their distance along the path, the distance of the nodes, the bands, the statistics of every segment,
+    the gaps after every iteration and whether the refinement stopped on the budget with intervals still above `tol`
+    '''
+    nodes_k = np.array(nodes)
+    seg_len = np.array([np.sqrt(dk @ k_metric @ dk) for dk in np.diff(nodes_k, axis=0)])
+    k_node = np.concatenate([[0], np.cumsum(seg_len)])
+
+    # every segment keeps its points as the fraction along the segment
+    segments = []
+    for s in range(len(seg_len)):
+        n = max(3, int(round(nk0*seg_len[s]/k_node[-1])) + 1)
+        segments.append({'x': np.linspace(0, 1, n), 'e': None, 'nk0': n, 'nrefined': []})
+
+    def get_k(s, x):
+        return nodes_k[s] + np.outer(x, nodes_k[s + 1] - nodes_k[s])
+
+    e = solve_points(np.concatenate([get_k(s, seg['x']) for s, seg in enumerate(segments)]))
+    rows = sum(get_tracked_rows(e.shape[0]).values(), [])
+    i = 0
+    for seg in segments:
+        seg['e'] = e[:, i:i + len(seg['x'])]
+        i += len(seg['x'])
+
+    history = []
+    budget_exhausted = False
+    for it in range(max_iter + 1):
+        new = []
+        for s, seg in enumerate(segments):
+            flags, err = flag_intervals(seg['x']*seg_len[s], seg['e'][rows]*1000, tol, min_dk)
+            seg['err'] = err
+            x = seg['x']
+            new.append((x[:-1][flags] + x[1:][flags])/2)
+            seg['nrefined'].append(int(flags.sum()))
+        history.append(get_gaps(np.concatenate([seg['e'] for seg in segments], axis=1)))
+        nnew = sum(len(x) for x in new)
+        print(f'iteration {it}: {nnew} new k points, ' + ', '.join(f'{key} {value:.3f} meV' for key, value in history[-1].items()))
+        if nnew == 0:
+            break
+        nk = sum(len(seg['x']) for seg in segments)
+        if it == max_iter or (max_nk is not None and nk + nnew > max_nk):
+            budget_exhausted = True
+            print(f'budget used up with {nnew} intervals above tol')
+            break
+
+        e = solve_points(np.concatenate([get_k(s, x) for s, x in enumerate(new)]))
+        i = 0
+        for seg, x in zip(segments, new):
+            x_all = np.concatenate([seg['x'], x])
+            e_all = np.concatenate([seg['e'], e[:, i:i + len(x)]], axis=1)
+            order = np.argsort(x_all)
+            seg['x'] = x_all[order]
+            seg['e'] = e_all[:, order]
+            i += len(x)
+
+    # concatenate the segments, the shared nodes are kept once
+    k_vec = []
+    k_dist = []
+    evals = []
+    stats = []
+    for s, seg in enumerate(segments):
+        start = 0 if s == 0 else 1
+        k_vec.append(get_k(s, seg['x'])[start:])
+        k_dist.append(k_node[s] + seg['x'][start:]*seg_len[s])
+        evals.append(seg['e'][:, start:])
+        gaps = get_gaps(seg['e'])
+        stats.append({
+            'segment': f'{node_labels[s]}-{node_labels[s + 1]}',
+            'nk0': seg['nk0'],
+            'nk': len(seg['x']),
+            'nrefined': seg['nrefined'],
+            'min_dk': float(np.min(np.diff(seg['x']))*seg_len[s]),
+            'max_err': float(np.max(seg['err'])),
+            **{key: float(value) for key, value in gaps.items()},
+            })
+    history = [{key: float(value) for key, value in gaps.items()} for gaps in history]
+    return np.concatenate(k_vec), np.concatenate(k_dist), k_node, np.concatenate(evals, axis=1), stats, history, budget_exhausted
+
+def write_bands(dirname, k_vec, k_dist, k_node, evals, mode, sigma):
+    '''
+    Writes the bands in the format of `solve.run_bands`, with every k point done
+    '''
+    os.makedirs(dirname, exist_ok=True)
+    np.savetxt(f'{dirname}/k_vec.txt', k_vec)
+    np.savetxt(f'{dirname}/k_dist.txt', k_dist)
+    np.savetxt(f'{dirname}/k_node.txt', k_node)
+    with h5py.File(solve.get_hdf_filename(dirname), 'w') as f:
+        f.attrs['mode'] = mode
+        f.attrs['sigma'] = np.nan if sigma is None else sigma
+        f['k_vec'] = k_vec
+        f['evals'] = evals
+        f['done'] = np.ones(len(k_vec), dtype=bool)
+        f['time'] = np.full(len(k_vec), np.nan)
+
+def run_adaptive(twist_angle, pot, relax_keyword, mode='sparse', nbands=None, sigma=None, max_energy=0.25, nk0=16, tol=0.1, min_dk=1e-5, max_iter=20, max_nk=None, nworkers=None):
+    letb, hoppings = solve.create_hoppings(twist_angle, pot, relax_keyword)
+    k_metric = get_k_metric(letb)
+    del letb
+    if mode == 'sparse':
+        sigma, nbands = solve.get_sparse_window(hoppings, np.array(nodes), nbands=nbands, sigma=sigma, max_energy=max_energy)
+
+    blocks, spec = hamiltonian.to_shared_memory(hoppings)
+    del hoppings
+    try:
+        with ProcessPoolExecutor(max_workers=nworkers, initializer=solve.init_worker, initargs=(spec, None, mode, nbands, sigma)) as executor:
+            solve_points = lambda k: np.column_stack(list(executor.map(solve.solve_point, k)))
+            k_vec, k_dist, k_node, evals, stats, history, budget_exhausted = refine(solve_points, k_metric, nk0=nk0, tol=tol, min_dk=min_dk,
+                max_iter=max_iter, max_nk=max_nk)
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+    dirname = f'bands/{twist_angle}_{pot}_{relax_keyword}_adaptive'
+    write_bands(dirname, k_vec, k_dist, k_node, evals, mode, sigma)
+    with open(f'{dirname}/refinement.json', 'w') as f:
+        f.write(json.dumps({'tol': tol, 'nk0': nk0, 'nk': len(k_vec), 'max_iter': max_iter, 'max_nk': max_nk, 'budget_exhausted': budget_exhausted,
+            'segments': stats, 'history': history}, indent=4))
+    for s in stats:
+        print(s)
+    return k_vec, k_dist, k_node, evals, stats
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('twist_angle')
+    parser.add_argument('pot')
+    parser.add_argument('relax_keyword')
+    parser.add_argument('--mode', default='sparse', choices=['dense', 'sparse'])
+    parser.add_argument('--nbands', default=None, type=int, help='number of bands around the Fermi level in the sparse mode, enough to cover `max_energy` if not given')
+    parser.add_argument('--sigma', default=None, type=float, help='shift of the sparse mode in eV, the Fermi level at K if not given')
+    parser.add_argument('--max_energy', default=0.25, type=float, help='energy range in eV around sigma covered by the sparse mode if `nbands` is not given')
+    parser.add_argument('--nk0', default=16, type=int, help='number of starting k points of the path')
+    parser.add_argument('--tol', default=0.1, type=float, help='interpolation error of the tracked bands in meV')
+    parser.add_argument('--max_iter', default=20, type=int, help='budget of refinement iterations')
+    parser.add_argument('--max_nk', default=None, type=int, help='budget of k points on the path, no limit if not given')
+    parser.add_argument('--nworkers', default=None, type=int)
+    args = parser.parse_args()
+    run_adaptive(args.twist_angle, args.pot, args.relax_keyword, mode=args.mode, nbands=args.nbands, sigma=args.sigma, max_energy=args.max_energy,
+        nk0=args.nk0, tol=args.tol, max_iter=args.max_iter, max_nk=args.max_nk, nworkers=args.nworkers)
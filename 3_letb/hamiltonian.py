@@ -0,0 +1,227 @@
+'''
+Builds the Bloch Hamiltonian of a LETB model as a sparse matrix and solves for the bands near the Fermi level
+
+The hoppings of the pythtb model from `bilayer_letb` are converted once into arrays.
+H(k) is assembled with the same convention as `pythtb.tb_model._gen_ham`, so the eigenvalues are the same as `letb.solve_one(k)`.
+`solve_sparse` uses shift-invert Lanczos (`scipy.sparse.linalg.eigsh`) to find only a window of `nbands` eigenvalues around `sigma`,
+and `get_nbands` sizes that window to an energy range.
+`to_shared_memory` places the arrays once in shared memory, so that process pool workers attach to them by name instead of receiving copies.
+`save_hopping_list` and `load_hopping_list` cache the hoppings of a model in a compressed npz file, named by `get_geometry_hash` of its structure and the version of `bilayer_letb`.
+'''
+import hashlib
+import importlib.metadata
+from multiprocessing import shared_memory
+import numpy as np
+import pythtb
+import scipy.sparse
+import scipy.sparse.linalg
+
+def get_hopping_list(letb):
+    '''
+    Returns the hoppings (amplitude, i, j, R) of the pythtb model `letb` as arrays, with the lattice and orbitals of the model
+    '''
+    return {
+        'amp': np.array([h[0] for h in letb._hoppings], dtype=float),
+        'i': np.array([h[1] for h in letb._hoppings], dtype=np.int64),
+        'j': np.array([h[2] for h in letb._hoppings], dtype=np.int64),
+        'R': np.array([h[3] for h in letb._hoppings], dtype=np.int64).reshape(-1, letb._dim_r),
+        'site_energies': np.asarray(letb._site_energies, dtype=float),
+        'lat': np.asarray(letb._lat),
+        'orb': np.asarray(letb._orb),
+        'per': np.asarray(letb._per),
+        }
+
+def get_hoppings(letb):
+    '''
+    Returns the hoppings of the pythtb model `letb` as a dictionary of arrays
+    `rv`: vector of each hopping in reduced coordinates, which gives the phase exp(2 pi i k.rv)
+    '''
+    return from_hopping_list(get_hopping_list(letb))
+
+def from_hopping_list(hopping_list):
+    h = hopping_list
+    rv = (h['orb'][h['j']] - h['orb'][h['i']] + h['R'])[:, h['per']]
+    return {
+        'norb': len(h['orb']),
+        'site_energies': h['site_energies'],
+        'amp': h['amp'],
+        'i': h['i'],
+        'j': h['j'],
+        'rv': rv,
+        }
+
+def get_model_tag():
+    '''
+    Returns the name and version of the package that builds the LETB hoppings
+    '''
+    return f'bilayer_letb {importlib.metadata.version("bilayer_letb")}'
+
+def get_geometry_hash(cell, positions, model_tag=None):
+    '''
+    Returns the SHA-1 of the LETB model `model_tag` (`get_model_tag()` if None) and the cell and the cartesian positions of a structure,
+    so the hoppings cached under it are not reused by another version of the model
+    '''
+    sha1 = hashlib.sha1()
+    sha1.update((get_model_tag() if model_tag is None else model_tag).encode())
+    for a in [cell, positions]:
+        a = np.ascontiguousarray(a, dtype=np.float64)
+        sha1.update(str(a.shape).encode())
+        sha1.update(a.tobytes())
+    return sha1.hexdigest()
+
+def save_hopping_list(filename, hopping_list):
+    np.savez_compressed(filename, **hopping_list)
+
+def load_hopping_list(filename):
+    with np.load(filename) as f:
+        return {key: f[key] for key in f.files}
+
+def get_path_model(hopping_list):
+    '''
+    Returns a pythtb model with the lattice and orbitals but without the hoppings, enough for `k_path`
+    '''
+    lat = hopping_list['lat']
+    per = hopping_list['per'].tolist()
+    return pythtb.tb_model(len(per), lat.shape[0], lat, hopping_list['orb'], per=per)
+
+def get_ham(hoppings, k):
+    '''
+    Returns H(k) as a sparse CSR matrix, `k` in reduced coordinates
+    '''
+    norb = hoppings['norb']
+    amp = hoppings['amp']*np.exp(2j*np.pi*(hoppings['rv'] @ np.asarray(k, dtype=float)))
+    A = scipy.sparse.coo_matrix((amp, (hoppings['i'], hoppings['j'])), shape=(norb, norb)).tocsr()
+    return A + A.conj().T + scipy.sparse.diags(hoppings['site_energies'].astype(complex))
+
+def solve_dense(hoppings, k):
+    '''
+    Returns all eigenvalues of H(k), sorted
+    '''
+    return np.linalg.eigvalsh(get_ham(hoppings, k).toarray())
+
+def count_below(ham, s):
+    '''
+    Returns the number of eigenvalues of the hermitian sparse matrix `ham` below `s`, None if it cannot be counted at `s`
+    By Sylvester's law of inertia it is the number of negative pivots of a symmetric factorization of ham - s,
+    which is an LU factorization with the same row and column permutations.
+    '''
+    shifted = scipy.sparse.csc_matrix(ham - s*scipy.sparse.identity(ham.shape[0], format='csc'))
+    try:
+        lu = scipy.sparse.linalg.splu(shifted, permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0, options=dict(SymmetricMode=True))
+    except RuntimeError:
+        # exactly singular
+        return None
+    if not np.array_equal(lu.perm_r, lu.perm_c):
+        return None
+    return int(np.sum(lu.U.diagonal().real < 0))
+
+def get_fermi_level(hoppings, k, tol=1e-8):
+    '''
+    Returns the charge neutrality level at one k point,
+    i.e. the midpoint between the highest occupied and the lowest unoccupied band
+    The level is bisected with `count_below` between the bounds of the spectrum until it lies in the gap,
+    whose edges are then found by a sparse solve, or until the bracket is narrower than `tol` in eV if the two bands are degenerate.
+    '''
+    ham = get_ham(hoppings, k)
+    nhalf = hoppings['norb']//2
+    bound = np.max(np.asarray(abs(ham).sum(axis=1)))
+    lo, hi = -bound, bound
+    while hi - lo > tol:
+        mid = (lo + hi)/2
+        n = count_below(ham, mid)
+        # nudge the shift off a singular or pivoted factorization
+        nudge = 0
+        while n is None:
+            nudge += 1
+            n = count_below(ham, mid + nudge*1e-3*(hi - lo))
+        mid += nudge*1e-3*(hi - lo)
+        if n < nhalf:
+            lo = mid
+        elif n > nhalf:
+            hi = mid
+        else:
+            nev = 2
+            while True:
+                evals = scipy.sparse.linalg.eigsh(ham, k=nev, sigma=mid, which='LM', return_eigenvectors=False)
+                if np.any(evals < mid) and np.any(evals >= mid):
+                    return (evals[evals < mid].max() + evals[evals >= mid].min())/2
+                nev *= 2
+    return (lo + hi)/2
+
+def solve_sparse(hoppings, k, nbands, sigma):
+    '''
+    Returns `nbands` eigenvalues of H(k) around `sigma`, the `nbands//2` highest below `sigma` and the lowest ones above it,
+    so row `nbands//2` is the band `norb//2` of the full spectrum, the lowest band above charge neutrality, if `sigma` is at charge neutrality.
+    The eigenvalues nearest `sigma` are not centered on it where the spectrum is denser on one side,
+    so the solve is repeated with more eigenvalues until both halves of the window are found, the last resort being a dense solve.
+    '''
+    ham = get_ham(hoppings, k)
+    norb = hoppings['norb']
+    nlow = nbands//2
+    nhigh = nbands - nlow
+    nev = nbands
+    while True:
+        if nev >= norb - 1:
+            evals = np.linalg.eigvalsh(ham.toarray())
+        else:
+            evals = np.sort(scipy.sparse.linalg.eigsh(ham, k=nev, sigma=sigma, which='LM', return_eigenvectors=False))
+        nbelow = np.sum(evals < sigma)
+        nabove = len(evals) - nbelow
+        if nbelow >= nlow and nabove >= nhigh:
+            return evals[nbelow - nlow:nbelow + nhigh]
+        if nev >= norb - 1:
+            raise ValueError(f'the window of {nbands} bands around sigma = {sigma} eV does not fit in the {norb} bands')
+        nev = min(nev + 2*max(nlow - nbelow, nhigh - nabove), norb - 1)
+
+def get_nbands(hoppings, ks, sigma, max_energy, nbands=64):
+    '''
+    Returns the number of bands of `solve_sparse` whose window covers [sigma - max_energy, sigma + max_energy] in eV at the k points `ks`
+    The window is doubled from `nbands` until its first and last bands are outside the energy range, then trimmed
+    to the bands in the range at the k point with the most of them plus one on each side.
+    '''
+    norb = hoppings['norb']
+    while True:
+        nbands = min(nbands, norb)
+        evals = np.array([solve_sparse(hoppings, k, nbands, sigma) for k in ks])
+        if (np.all(evals[:, 0] < sigma - max_energy) and np.all(evals[:, -1] > sigma + max_energy)) or nbands == norb:
+            break
+        nbands *= 2
+    nlow = np.max(np.sum((evals >= sigma - max_energy) & (evals < sigma), axis=1)) + 1
+    nhigh = np.max(np.sum((evals >= sigma) & (evals <= sigma + max_energy), axis=1)) + 1
+    return int(min(2*max(nlow, nhigh), nbands))
+
+def to_shared_memory(hoppings):
+    '''
+    Copies the arrays of `hoppings` into shared memory blocks
+    Returns the blocks, which the caller closes and unlinks when the workers are done,
+    and a small picklable description of them for `from_shared_memory`
+    '''
+    blocks = []
+    spec = {}
+    for key, value in hoppings.items():
+        if not isinstance(value, np.ndarray):
+            spec[key] = value
+            continue
+        shm = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+        np.ndarray(value.shape, dtype=value.dtype, buffer=shm.buf)[...] = value
+        blocks.append(shm)
+        spec[key] = (shm.name, value.shape, value.dtype.str)
+    return blocks, spec
+
+def from_shared_memory(spec):
+    '''
+    Attaches to the blocks of `to_shared_memory`, returns the blocks and the hoppings as read-only arrays on them
+    '''
+    blocks = []
+    hoppings = {}
+    for key, value in spec.items():
+        if not isinstance(value, tuple):
+            hoppings[key] = value
+            continue
+        name, shape, dtype = value
+        shm = shared_memory.SharedMemory(name=name)
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        array.flags.writeable = False
+        blocks.append(shm)
+        hoppings[key] = array
+    return blocks, hoppings
@@ -1,3 +1,4 @@
+import h5py
 import numpy as np
 import os
 
@@ -30,9 +31,18 @@ def test_trim():
 def concat_evals(twist_angle, pot):
     '''
     Combines all the band energy at each k point to a single matrix, where energies are rows and k-points are columns
+    The matrix is read from `bands.hdf5` of `solve.py`, or from the `bands_XX.npy` files of the k points of older runs
     '''
     l = []
     dirname = f'bands/{twist_angle}_{pot}'
+    hdf_filename = f'{dirname}/bands.hdf5'
+    if os.path.isfile(hdf_filename):
+        with h5py.File(hdf_filename, 'r') as f:
+            done = f['done'][()]
+            if not done.all():
+                raise ValueError(f'k points {np.flatnonzero(~done).tolist()} of {hdf_filename} are not done')
+            np.savetxt(f'{dirname}/bands.txt', f['evals'][()])
+        return
     k_dist = np.loadtxt(f'{dirname}/k_dist.txt')
     nk = k_dist.shape[0]
     for k_idx in range(nk):
@@ -41,28 +51,72 @@ def concat_evals(twist_angle, pot):
     evals = np.concatenate(l, axis=1)
     np.savetxt(f'{dirname}/bands.txt', evals)
 
-def load_evals(twist_angle, pot, max_energy=None):
+def get_source_filename(dirname):
+    '''
+    Returns the file the band store is built from, `bands.hdf5` of `solve.py` or `bands.txt` of `concat_evals`
+    '''
+    hdf_filename = f'{dirname}/bands.hdf5'
+    return hdf_filename if os.path.isfile(hdf_filename) else f'{dirname}/bands.txt'
+
+def write_band_store(twist_angle, pot):
+    '''
+    Writes the band structure in meV, centered at the fermi level, to `bands_mev.npy`,
+    and the fermi level shift and the minimum and maximum of every band over the k points to `bands_window.npz`
+    '''
     dirname = f'bands/{twist_angle}_{pot}'
-    bands_txt = f'{dirname}/bands.txt'
-    if not os.path.isfile(bands_txt):
-        concat_evals(twist_angle, pot)
-    evals = np.loadtxt(bands_txt)
+    source_filename = get_source_filename(dirname)
+    if source_filename.endswith('.hdf5'):
+        with h5py.File(source_filename, 'r') as f:
+            done = f['done'][()]
+            if not done.all():
+                raise ValueError(f'k points {np.flatnonzero(~done).tolist()} of {source_filename} are not done')
+            evals = f['evals'][()]
+    else:
+        if not os.path.isfile(source_filename):
+            concat_evals(twist_angle, pot)
+        evals = np.loadtxt(source_filename)
+    if np.isnan(evals).any():
+        raise ValueError(f'{source_filename} has bands that were not found, rerun it')
     evals *= 1000 # convert eV to meV
 
     # center the band structure at the fermi level
-    evals -= min(evals[int(evals.shape[0]/2), :])
+    shift = min(evals[int(evals.shape[0]/2), :])
+    evals -= shift
 
-    # filter the energy outside of the range [-max_energy, max_energy]
-    first_idxs = []
-    last_idxs = []
-    nk = evals.shape[1]
-    for k_idx in range(nk):
-        if max_energy is not None:
-            first_idx, last_idx = trim(evals[:, k_idx], max_energy)
-        else:
-            first_idx = 0
-            last_idx = -1
-        first_idxs.append(first_idx)
-        last_idxs.append(last_idx)
-    evals_within_max_energy = evals[min(first_idxs):max(last_idxs), :]
-    return evals_within_max_energy
+    np.save(f'{dirname}/bands_mev.npy', evals)
+    np.savez(f'{dirname}/bands_window.npz', shift=shift, band_min=np.nanmin(evals, axis=1), band_max=np.nanmax(evals, axis=1))
+
+def get_window(band_min, band_max, max_energy):
+    '''
+    Returns the first and last band of the window [-max_energy, max_energy], the same as `trim` at every k point:
+    the bands before `first` are below -max_energy at all k points and the bands from `last` on are above max_energy at all k points.
+    The minimum and maximum of sorted bands are sorted, so both are found by bisection.
+    '''
+    first = np.searchsorted(band_max, -max_energy, side='right')
+    last = np.searchsorted(band_min, max_energy, side='right')
+    return first, last
+
+def load_evals(twist_angle, pot, max_energy=None):
+    '''
+    Returns the bands in meV relative to the fermi level within [-max_energy, max_energy], or all but the last band if None
+    The bands are read from the band store of `write_band_store`, which is rebuilt when its source is newer,
+    and only the rows of the window are read from the memory map.
+    '''
+    dirname = f'bands/{twist_angle}_{pot}'
+    store_filename = f'{dirname}/bands_mev.npy'
+    window_filename = f'{dirname}/bands_window.npz'
+    source_filename = get_source_filename(dirname)
+    if not os.path.isfile(window_filename) or (os.path.isfile(source_filename) and os.path.getmtime(source_filename) > os.path.getmtime(window_filename)):
+        write_band_store(twist_angle, pot)
+
+    evals = np.load(store_filename, mmap_mode='r')
+    if max_energy is None:
+        return np.array(evals[0:-1, :])
+    with np.load(window_filename) as window:
+        band_min = window['band_min']
+        band_max = window['band_max']
+    # the bands of a sparse run are a window, which has to reach beyond the energy range at every k point
+    if band_max[0] > -max_energy or band_min[-1] < max_energy:
+        raise ValueError(f'the bands of {dirname} do not cover [-{max_energy}, {max_energy}] meV, rerun the sparse mode with more bands')
+    first, last = get_window(band_min, band_max, max_energy)
+    return np.array(evals[first:last, :])
@@ -0,0 +1,176 @@
+'''
+Solves the band structures of many (twist angle, potential, relax keyword) structures on one node, as an alternative to a job per structure of `submit.py`
+
+The k points of all structures are tasks of one process pool sized to the machine, whose idle workers take the next task.
+The structures are started largest first by atom count, so the longest k points do not end up last.
+The main process builds the hoppings of a structure once and places them in shared memory,
+and every worker keeps the hoppings of the last `cache_size` structures it solved attached, so they are reused across k points.
+At most `max_resident` structures are in flight at a time, the shared memory of a structure is released when its last k point is done.
+The bands are stored in `bands/{twist_angle}_{pot}_{relax_keyword}/bands.hdf5` as by `solve.py`, and a run resumes from the k points that are not done.
+'''
+import argparse
+import collections
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import datetime
+import h5py
+import numpy as np
+import os
+import time
+
+import hamiltonian
+import solve
+
+# hoppings attached by the worker, the most recently used last
+_cache = collections.OrderedDict()
+
+def get_natoms(twist_angle, pot, relax_keyword):
+    '''
+    Returns the number of atoms of the hexagonal cell of a structure, 0 if it does not exist
+    '''
+    relaxed = 'rigid' not in relax_keyword
+    if solve.geom_store.has_structure(pot, twist_angle, relaxed):
+        with h5py.File(solve.geom_store.store_filename, 'r') as f:
+            return f[solve.geom_store.get_key(pot, twist_angle, relaxed)]['hex_positions'].shape[0]
+    poscar_path = f'../2_optimized_geometry/kc_{pot}/raw/POSCAR_{twist_angle}{relax_keyword}_hex.txt'
+    if os.path.isfile(poscar_path):
+        with open(poscar_path) as f:
+            return len(f.read().split('\n')[8:-1])
+    return 0
+
+def attach(key, spec, cache_size):
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key][1]
+    blocks, hoppings = hamiltonian.from_shared_memory(spec)
+    _cache[key] = (blocks, hoppings)
+    while len(_cache) > cache_size:
+        _, (old_blocks, _) = _cache.popitem(last=False)
+        for shm in old_blocks:
+            shm.close()
+    return hoppings
+
+def solve_task(key, spec, k, mode, nbands, sigma, cache_size):
+    '''
+    Solves the k point `k` of the structure `key`, returns the eigenvalues and the time of the solve
+    '''
+    hoppings = attach(key, spec, cache_size)
+    start = time.perf_counter()
+    evals = solve.solve_k(hoppings, k, mode, nbands, sigma)
+    return evals, time.perf_counter() - start
+
+def prepare(twist_angle, pot, relax_keyword, mode, nbands, sigma, nk, max_energy):
+    '''
+    Builds the hoppings of a structure, writes its k path and returns its run, None if all of its k points are done
+    '''
+    letb, hoppings = solve.create_hoppings(twist_angle, pot, relax_keyword)
+    k_vec, k_dist, k_node = letb.k_path(solve.k_nodes, nk, report=False)
+    dirname = f'bands/{twist_angle}_{pot}_{relax_keyword}'
+    os.makedirs(dirname, exist_ok=True)
+
+    del letb
+    hdf_filename = solve.get_hdf_filename(dirname)
+    if mode == 'sparse':
+        sigma, nbands = solve.get_sparse_window(hoppings, k_vec, hdf_filename, nbands=nbands, sigma=sigma, max_energy=max_energy)
+    nrows = nbands if mode == 'sparse' else hoppings['norb']
+    solve.init_hdf(hdf_filename, k_vec, mode, nrows, sigma)
+    # only after the check of init_hdf, so a band file of a different run keeps its k path
+    np.savetxt(f'{dirname}/k_vec.txt', k_vec)
+    np.savetxt(f'{dirname}/k_dist.txt', k_dist)
+    np.savetxt(f'{dirname}/k_node.txt', k_node)
+    with h5py.File(hdf_filename, 'r') as f:
+        todo = np.flatnonzero(~f['done'][()])
+    print(f'{dirname}: {len(k_vec) - len(todo)} of {len(k_vec)} k points already done')
+    if len(todo) == 0:
+        return None
+
+    blocks, spec = hamiltonian.to_shared_memory(hoppings)
+    return {'hdf_filename': hdf_filename, 'k_vec': k_vec, 'todo': todo, 'nbands': nbands, 'sigma': sigma, 'blocks': blocks, 'spec': spec, 'nleft': len(todo)}
+
+def release(run):
+    for shm in run['blocks']:
+        shm.close()
+        shm.unlink()
+
+def run_schedule(twist_angles, pots, relax_keywords, mode='dense', nbands=None, sigma=None, nk=100, max_energy=0.25, nworkers=None, cache_size=2, max_resident=2):
+    '''
+    Solves all k points of all structures, largest structure first
+    '''
+    print(datetime.datetime.now())
+    structures = [(twist_angle, pot, relax_keyword) for twist_angle in twist_angles for pot in pots for relax_keyword in relax_keywords]
+    natoms = {s: get_natoms(*s) for s in structures}
+    for s in structures:
+        if natoms[s] == 0:
+            print(f'skipping {s}: no structure')
+    queue = sorted([s for s in structures if natoms[s] > 0], key=lambda s: natoms[s], reverse=True)
+
+    runs = {}
+    futures = {}
+    failed = []
+    nworkers = os.cpu_count() if nworkers is None else nworkers
+    with ProcessPoolExecutor(max_workers=nworkers) as executor:
+        try:
+            while queue or futures:
+                # start the next structures while the workers are busy with the ones in flight
+                while queue and len(runs) < max_resident:
+                    s = queue.pop(0)
+                    print(f'starting {s}: {natoms[s]} atoms')
+                    try:
+                        run = prepare(*s, mode, nbands, sigma, nk, max_energy)
+                    except Exception as e:
+                        # e.g. a band file of a different run, the other structures go on
+                        failed.append((s, None))
+                        print(f'{s} failed: {e!r}')
+                        continue
+                    if run is None:
+                        continue
+                    runs[s] = run
+                    for k_idx in run['todo']:
+                        future = executor.submit(solve_task, s, run['spec'], run['k_vec'][k_idx], mode, run['nbands'], run['sigma'], cache_size)
+                        futures[future] = (s, k_idx)
+                if not futures:
+                    continue
+
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    s, k_idx = futures.pop(future)
+                    run = runs[s]
+                    try:
+                        evals, t = future.result()
+                    except Exception as e:
+                        failed.append((s, k_idx))
+                        print(f'{s} k point {k_idx:02} failed: {e!r}')
+                    else:
+                        with h5py.File(run['hdf_filename'], 'a') as f:
+                            f['evals'][:, k_idx] = evals
+                            f['time'][k_idx] = t
+                            f['done'][k_idx] = True
+                        print(f'{s} k point {k_idx:02}: {t:.1f} s')
+                    run['nleft'] -= 1
+                    if run['nleft'] == 0:
+                        release(runs.pop(s))
+                        print(f'finished {s}')
+        finally:
+            for future in futures:
+                future.cancel()
+            for run in runs.values():
+                release(run)
+    print(datetime.datetime.now())
+    if failed:
+        raise RuntimeError(f'k points {failed} failed (None for a whole structure), rerun to retry them')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--twist_angles', nargs='+', default=['0-84', '0-93', '0-99', '1-05', '1-08', '1-16'])
+    parser.add_argument('--pots', nargs='+', default=['qmc', 'ouyang', 'dft_d2', 'dft_d3'])
+    parser.add_argument('--relax_keywords', nargs='+', default=['relax', 'rigid'])
+    parser.add_argument('--mode', default='dense', choices=['dense', 'sparse'])
+    parser.add_argument('--nbands', default=None, type=int, help='number of bands around the Fermi level in the sparse mode, enough to cover `max_energy` for every structure if not given')
+    parser.add_argument('--sigma', default=None, type=float, help='shift of the sparse mode in eV, the Fermi level at K of every structure if not given')
+    parser.add_argument('--nk', default=100, type=int)
+    parser.add_argument('--max_energy', default=0.25, type=float, help='energy range in eV around sigma covered by the sparse mode if `nbands` is not given')
+    parser.add_argument('--nworkers', default=None, type=int, help='number of workers, the number of CPUs if not given')
+    parser.add_argument('--cache_size', default=2, type=int, help='number of structures kept attached by every worker')
+    parser.add_argument('--max_resident', default=2, type=int, help='number of structures in shared memory at a time')
+    args = parser.parse_args()
+    run_schedule(args.twist_angles, args.pots, args.relax_keywords, mode=args.mode, nbands=args.nbands, sigma=args.sigma, nk=args.nk, max_energy=args.max_energy,
+        nworkers=args.nworkers, cache_size=args.cache_size, max_resident=args.max_resident)
@@ -1,12 +1,25 @@
-from concurrent.futures import ProcessPoolExecutor
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import datetime
+import h5py
 import json
 import os
 import sys
+import time
 
 import ase
 from pythtb import *
 from bilayer_letb.api import tb_model
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../2_optimized_geometry'))
+import geom_store
+import hamiltonian
+
+hopping_cache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hoppings')
+
+# K - Gamma - M - K'
+k_nodes = [[1/3., 2/3.], [0.0, 0.0], [0.5, 0.0], [2/3., 1/3.]]
+
 def read_poscar(poscar_path):
     with open(poscar_path) as f:
         text = f.read()
@@ -16,46 +29,231 @@ def read_poscar(poscar_path):
     atoms = [[float(coord) for coord in l.split()] for l in lines[8:-1]]
     return latvec, atoms
 
-def create_letb(twist_angle, pot, relax_keyword):
+def read_structure(twist_angle, pot, relax_keyword):
     '''
+    Returns the cell and cartesian positions of the hexagonal cell of a structure from the geometry store or its POSCAR, None if neither exists
     `relax_keyword` is either `relax` or `rigid`
     '''
     poscar_path = f'../2_optimized_geometry/kc_{pot}/raw/POSCAR_{twist_angle}{relax_keyword}_hex.txt'
+    relaxed = 'rigid' not in relax_keyword
 
-    if os.path.isfile(poscar_path):
-        # compute hoppings
+    if geom_store.has_structure(pot, twist_angle, relaxed):
+        structure = geom_store.read_structure(pot, twist_angle, relaxed, fields=['hex_cell', 'hex_positions'], mmap=True)
+        return structure['hex_cell'], structure['hex_positions']
+    elif os.path.isfile(poscar_path):
         lattice_vectors, atomic_basis = read_poscar(poscar_path)
-        natoms = len(atomic_basis)
-        ase_atoms = ase.Atoms(['C']*natoms, positions=atomic_basis, cell=lattice_vectors, pbc=True)
-        letb = tb_model(ase_atoms)
-        return letb
+        return np.array(lattice_vectors), np.array(atomic_basis)
     else:
         print(f'poscar does not exist!!!: {poscar_path}')
 
-def solve_bands(letb, dirname, k_vec, k_idx):
-    output = f'bands_{k_idx:02}.npy'
+def create_letb(twist_angle, pot, relax_keyword):
+    '''
+    `relax_keyword` is either `relax` or `rigid`
+    '''
+    structure = read_structure(twist_angle, pot, relax_keyword)
+    if structure is None:
+        return None
+    # compute hoppings
+    cell, positions = structure
+    ase_atoms = ase.Atoms(['C']*len(positions), positions=positions, cell=cell, pbc=True)
+    letb = tb_model(ase_atoms)
+    return letb
+
+def create_hoppings(twist_angle, pot, relax_keyword, cache_dir=hopping_cache_dir):
+    '''
+    Returns a pythtb model for `k_path` and the hoppings of `hamiltonian.get_hoppings` of a structure, None if it does not exist
+    The hoppings are cached in `{cache_dir}/{sha1}.npz`, keyed by the SHA-1 of the `bilayer_letb` version, the cell and the positions,
+    so the LETB model is only built for a new structure or a new version of the model.
+    '''
+    structure = read_structure(twist_angle, pot, relax_keyword)
+    if structure is None:
+        return None
+    cell, positions = structure
+    filename = os.path.join(cache_dir, f'{hamiltonian.get_geometry_hash(cell, positions)}.npz')
+    if os.path.isfile(filename):
+        hopping_list = hamiltonian.load_hopping_list(filename)
+        return hamiltonian.get_path_model(hopping_list), hamiltonian.from_hopping_list(hopping_list)
+
+    ase_atoms = ase.Atoms(['C']*len(positions), positions=positions, cell=cell, pbc=True)
+    letb = tb_model(ase_atoms)
+    hopping_list = hamiltonian.get_hopping_list(letb)
+    os.makedirs(cache_dir, exist_ok=True)
+    hamiltonian.save_hopping_list(filename, hopping_list)
+    return letb, hamiltonian.from_hopping_list(hopping_list)
 
-    workdir = os.getcwd()
-    os.chdir(dirname)
+# state of the process pool workers, set once by `init_worker`
+_worker = {}
+
+def init_worker(spec, k_vec, mode, nbands, sigma):
+    '''
+    Attaches the worker to the hoppings in shared memory described by `spec`
+    '''
+    blocks, hoppings = hamiltonian.from_shared_memory(spec)
+    _worker.update(blocks=blocks, hoppings=hoppings, k_vec=k_vec, mode=mode, nbands=nbands, sigma=sigma)
+
+def solve_k(hoppings, k, mode='dense', nbands=64, sigma=None):
+    '''
+    `mode`: `dense` diagonalizes the full Hamiltonian, `sparse` finds a window of `nbands` bands around `sigma`
+    '''
+    if mode == 'sparse':
+        return hamiltonian.solve_sparse(hoppings, k, nbands, sigma)
+    return hamiltonian.solve_dense(hoppings, k)
+
+def solve_bands(k_idx):
+    '''
+    Solves the k point `k_idx` in a worker set up by `init_worker`, returns the eigenvalues and the time of the solve
+    '''
+    w = _worker
+    start = time.perf_counter()
+    evals = solve_k(w['hoppings'], w['k_vec'][k_idx], w['mode'], w['nbands'], w['sigma'])
+    return evals, time.perf_counter() - start
+
+def solve_point(k):
+    '''
+    Solves the k point `k` in a worker set up by `init_worker`, for k points that are not on the k path of the pool
+    '''
+    w = _worker
+    return solve_k(w['hoppings'], k, w['mode'], w['nbands'], w['sigma'])
 
-    evals = letb.solve_one(k_vec[k_idx]).reshape(-1, 1)
-    np.save(output, arr=evals)
-    os.chdir(workdir)
+def get_hdf_filename(dirname):
+    return f'{dirname}/bands.hdf5'
+
+def init_hdf(hdf_filename, k_vec, mode, nbands, sigma):
+    '''
+    Creates the band file with the eigenvalues `evals` (nbands, nk), the completion mask `done` and the solve time of every k point,
+    or checks that an existing one belongs to the same run
+    '''
+    if os.path.isfile(hdf_filename):
+        with h5py.File(hdf_filename, 'r') as f:
+            run = (f.attrs['mode'], f['evals'].shape, float(f.attrs['sigma']))
+            same_k = np.allclose(f['k_vec'][()], k_vec) if f['k_vec'].shape == k_vec.shape else False
+        same_sigma = np.isclose(run[2], np.nan if sigma is None else sigma, equal_nan=True)
+        if run[:2] != (mode, (nbands, len(k_vec))) or not same_k or not same_sigma:
+            raise ValueError(f'{hdf_filename} was created by a different run: (mode, (nbands, nk), sigma) = {run}')
+        return
+
+    with h5py.File(hdf_filename, 'w') as f:
+        f.attrs['mode'] = mode
+        f.attrs['sigma'] = np.nan if sigma is None else sigma
+        f['k_vec'] = k_vec
+        f['evals'] = np.full((nbands, len(k_vec)), np.nan)
+        f['done'] = np.zeros(len(k_vec), dtype=bool)
+        f['time'] = np.full(len(k_vec), np.nan)
+
+def read_sigma(hdf_filename):
+    '''
+    Returns the shift of the sparse mode of an existing band file, None otherwise
+    '''
+    if not os.path.isfile(hdf_filename):
+        return None
+    with h5py.File(hdf_filename, 'r') as f:
+        sigma = f.attrs['sigma']
+    return None if np.isnan(sigma) else float(sigma)
+
+def read_nbands(hdf_filename):
+    '''
+    Returns the number of bands of the sparse mode of an existing band file, None otherwise
+    '''
+    if not os.path.isfile(hdf_filename):
+        return None
+    with h5py.File(hdf_filename, 'r') as f:
+        return f['evals'].shape[0] if f.attrs['mode'] == 'sparse' else None
+
+def get_sparse_window(hoppings, k_vec, hdf_filename=None, nbands=None, sigma=None, max_energy=0.25):
+    '''
+    Returns the shift `sigma` and the number of bands `nbands` of the sparse mode, where the ones not given are those of an existing band file,
+    or else the Fermi level at K and the number of bands covering [sigma - max_energy, sigma + max_energy] in eV at every tenth k point of `k_vec`
+    '''
+    if hdf_filename is not None:
+        sigma = read_sigma(hdf_filename) if sigma is None else sigma
+        nbands = read_nbands(hdf_filename) if nbands is None else nbands
+    if sigma is None:
+        sigma = hamiltonian.get_fermi_level(hoppings, k_nodes[0])
+    if nbands is None:
+        nbands = hamiltonian.get_nbands(hoppings, k_vec[::max(1, len(k_vec)//10)], sigma, max_energy)
+        print(f'{nbands} bands cover {max_energy} eV around sigma = {sigma} eV')
+    return sigma, nbands
+
+def run_bands(hoppings, k_vec, dirname, mode='dense', nbands=64, sigma=None, nworkers=None):
+    '''
+    Solves the k points of `k_vec` on a process pool and stores them in `get_hdf_filename(dirname)` as they finish
+    A run that was interrupted resumes from the k points that are not done in that file.
+    '''
+    print(datetime.datetime.now())
+    hdf_filename = get_hdf_filename(dirname)
+    nrows = nbands if mode == 'sparse' else hoppings['norb']
+    init_hdf(hdf_filename, k_vec, mode, nrows, sigma)
+
+    failed = []
+    with h5py.File(hdf_filename, 'a') as f:
+        todo = np.flatnonzero(~f['done'][()])
+        print(f'{len(k_vec) - len(todo)} of {len(k_vec)} k points already done')
+        if len(todo) == 0:
+            return
+
+        blocks, spec = hamiltonian.to_shared_memory(hoppings)
+        try:
+            with ProcessPoolExecutor(max_workers=nworkers, initializer=init_worker, initargs=(spec, k_vec, mode, nbands, sigma)) as executor:
+                futures = {executor.submit(solve_bands, k_idx): k_idx for k_idx in todo}
+                for future in as_completed(futures):
+                    k_idx = futures[future]
+                    try:
+                        evals, t = future.result()
+                    except Exception as e:
+                        failed.append(k_idx)
+                        print(f'k point {k_idx:02} failed: {e!r}')
+                        continue
+                    f['evals'][:, k_idx] = evals
+                    f['time'][k_idx] = t
+                    f['done'][k_idx] = True
+                    f.flush()
+                    print(f'k point {k_idx:02}: {t:.1f} s')
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+    print(datetime.datetime.now())
+    if failed:
+        raise RuntimeError(f'k points {sorted(failed)} failed, rerun to retry them')
+
+def read_bands(dirname):
+    '''
+    Returns the eigenvalues (nbands, nk) of a finished run
+    '''
+    with h5py.File(get_hdf_filename(dirname), 'r') as f:
+        done = f['done'][()]
+        if not done.all():
+            raise ValueError(f'k points {np.flatnonzero(~done).tolist()} of {get_hdf_filename(dirname)} are not done')
+        return f['evals'][()]
 
 if __name__ == '__main__':
-    if len(sys.argv) == 4:
-        twist_angle = sys.argv[1]
-        pot = sys.argv[2]
-        relax_keyword = sys.argv[3]
-
-        with ProcessPoolExecutor(max_workers=100) as client:
-            nk = 100
-            letb = create_letb(twist_angle, pot, relax_keyword)
-            k = [[1/3., 2/3.], [0.0, 0.0], [0.5, 0.0], [2/3., 1/3.]]
-            k_vec, k_dist, k_node = letb.k_path(k, nk)
-            dirname = f'bands/{twist_angle}_{pot}_{relax_keyword}'
-            os.makedirs(dirname, exist_ok=True)
-            np.savetxt(f'{dirname}/k_vec.txt', k_vec)
-            np.savetxt(f'{dirname}/k_dist.txt', k_dist)
-            np.savetxt(f'{dirname}/k_node.txt', k_node)
-            jobs = [client.submit(solve_bands, letb, dirname, k_vec, k_idx) for k_idx in range(nk)]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('twist_angle')
+    parser.add_argument('pot')
+    parser.add_argument('relax_keyword')
+    parser.add_argument('--mode', default='dense', choices=['dense', 'sparse'])
+    parser.add_argument('--nbands', default=None, type=int, help='number of bands around the Fermi level in the sparse mode, enough to cover `max_energy` if not given')
+    parser.add_argument('--sigma', default=None, type=float, help='shift of the sparse mode in eV, the Fermi level at K if not given')
+    parser.add_argument('--max_energy', default=0.25, type=float, help='energy range in eV around sigma covered by the sparse mode if `nbands` is not given')
+    parser.add_argument('--nk', default=100, type=int)
+    parser.add_argument('--nworkers', default=None, type=int, help='number of workers, the number of CPUs if not given')
+    args = parser.parse_args()
+    twist_angle = args.twist_angle
+    pot = args.pot
+    relax_keyword = args.relax_keyword
+
+    nk = args.nk
+    letb, hoppings = create_hoppings(twist_angle, pot, relax_keyword)
+    k_vec, k_dist, k_node = letb.k_path(k_nodes, nk)
+    dirname = f'bands/{twist_angle}_{pot}_{relax_keyword}'
+    os.makedirs(dirname, exist_ok=True)
+    np.savetxt(f'{dirname}/k_vec.txt', k_vec)
+    np.savetxt(f'{dirname}/k_dist.txt', k_dist)
+    np.savetxt(f'{dirname}/k_node.txt', k_node)
+
+    del letb
+    sigma = None
+    nbands = args.nbands
+    if args.mode == 'sparse':
+        sigma, nbands = get_sparse_window(hoppings, k_vec, get_hdf_filename(dirname), nbands=nbands, sigma=args.sigma, max_energy=args.max_energy)
+    run_bands(hoppings, k_vec, dirname, mode=args.mode, nbands=nbands, sigma=sigma, nworkers=args.nworkers)